@@ -0,0 +1,596 @@
+import argparse
+import ast
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import sklearn
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS, TfidfVectorizer
+from mono import (FeatureStore, NarrationNormalizer, TransactionColumns, assemble_groups, batch_transaction_grouping,
+                  canonical_buckets, choose_n_clusters, cluster_features, date_gap_statistics, deduplicate,
+                  encode_groups, ensure_corpora, json_loads, label_transactions, transaction_grouping,
+                  vectorize_narrations, warm_up)
+
+# narration templates modelled on the sample statement in mono.py
+NARRATION_TEMPLATES = ["NIP/FBN/{name}/FBNMOBILE:{name}/TRANSFER",
+                       "NIP/GTB/{name}/REF{ref}",
+                       "NIP CR/{name}/FBN",
+                       "MC POS Intl- APPLE.COM/BILL - {hex} - {day:02d}/{month:02d}/2022",
+                       "MC Loc POS Prch-{ref}--{merchant} LA LANG-",
+                       "MC Loc Web Prch-{ref}--{merchant} NG-",
+                       "*ISO:MC Loc Web PYT Fee-{ref}--{merchant} LANG-",
+                       "USSD -{short}- -{short}-{merchant} LA  LANG",
+                       "USSD Session Charge",
+                       "SMS Notification Charge {month_name} 2022",
+                       "Airtime//234{ref}//airtel",
+                       "NIP Charge + VAT",
+                       "STAMP DUTY CHARGE",
+                       "Transfer Charges"]
+NAMES = ["CHUKWUMA HILARY AKPU", "CHINAZA EMMANUEL AKPU", "DUNKWU CHARLES ELOKA", "FRIDAY JOHN"]
+MERCHANTS = ["CHICKEN REPUBLIC", "BLACKBELL RESTAURANT", "Shoprite Grand Towers", "TEAMAPT LIMITED"]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def synthetic_columns(n_rows, seed=6):
+    """
+    Builds transaction columns and cluster labels resembling a statement of n_rows transactions
+    :param n_rows: number of transactions :type int
+    :param seed: random seed :type int
+    :return: (columns, labels, n_groups) :type tuple
+    """
+    rng = random.Random(seed)
+    n_groups = max(1, round(n_rows / 3.2))
+    columns = {"narration": [f"NIP/FBN/NARRATION {rng.randrange(n_rows)}" for _ in range(n_rows)],
+               "amount": [rng.randrange(100, 500000) for _ in range(n_rows)],
+               "type": [rng.choice(("debit", "credit")) for _ in range(n_rows)],
+               "date": [f"2022-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T14:06:00.000Z"
+                        for _ in range(n_rows)]}
+    labels = np.array([rng.randrange(n_groups) for _ in range(n_rows)])
+    return columns, labels, n_groups
+
+
+def synthetic_narrations(n_rows, seed=6):
+    """
+    Builds narrations following the patterns of the sample statement
+    :param n_rows: number of narrations :type int
+    :param seed: random seed :type int
+    :return: narrations :type list of str
+    """
+    rng = random.Random(seed)
+    narrations = []
+    for _ in range(n_rows):
+        month = rng.randint(1, 12)
+        narrations.append(rng.choice(NARRATION_TEMPLATES).format(
+            name=rng.choice(NAMES), merchant=rng.choice(MERCHANTS), ref=rng.randrange(10 ** 11),
+            hex=f"{rng.randrange(16 ** 6):06X}", short=f"{rng.randrange(10 ** 6):06d}",
+            day=rng.randint(1, 28), month=month, month_name=MONTHS[month - 1]))
+    return narrations
+
+
+def synthetic_statement(n_rows, seed=6, transactions_per_day=5):
+    """
+    Builds a statement like the ones posted to the API, latest transaction first
+    :param n_rows: number of transactions :type int
+    :param seed: random seed :type int
+    :param transactions_per_day: average number of transactions on a day, sets the span of the dates :type int
+    :return: transactions :type list of dict
+    """
+    rng = random.Random(seed)
+    last_day = np.datetime64("2022-04-30")
+    days_back = sorted(rng.randrange(max(1, n_rows // transactions_per_day)) for _ in range(n_rows))
+    return [{"narration": narration,
+             "amount": rng.randrange(100, 500000),
+             "type": "credit" if narration.startswith("NIP/") else "debit",
+             "date": f"{last_day - days}T{rng.randrange(24):02d}:{rng.randrange(60):02d}:00.000Z"}
+            for narration, days in zip(synthetic_narrations(n_rows, seed), days_back)]
+
+
+def corpora_available():
+    """
+    :return: whether the nltk corpora are installed locally :type bool
+    """
+    try:
+        ensure_corpora()
+        return True
+    except LookupError:
+        return False
+
+
+def offline_normalizer():
+    """
+    Narration normalizer that works on machines without the nltk corpora, using sklearn's stopwords \
+    and no lemmatization, so timings are comparable but not identical to the nltk one
+    """
+    return NarrationNormalizer(stop_words=ENGLISH_STOP_WORDS, lemmatize=str)
+
+
+def benchmark_normalizer():
+    """
+    :return: the normalizer used in production if the nltk corpora are installed, else offline_normalizer() \
+    :type NarrationNormalizer
+    """
+    return NarrationNormalizer() if corpora_available() else offline_normalizer()
+
+
+def legacy_text_process(text):
+    """
+    Per-call text preprocessing previously used by transaction_grouping, kept as a reference point
+    """
+    stop_words = stopwords.words("english")
+    lem = WordNetLemmatizer()
+    text = re.sub("[^a-zA-Z]", " ", text)
+    text = text.split()
+    text = [lem.lemmatize(word.lower()) for word in text if not word in stop_words]
+    return " ".join(text)
+
+
+def legacy_assemble_groups(labels, columns, n_groups):
+    """
+    Per-cluster DataFrame scan previously used by transaction_grouping, kept as a reference point
+    """
+    df = pd.DataFrame(dict(columns, groups=labels))
+    df2 = df.drop(["groups"], axis=1)
+    transactions_list = []
+    for m in range(n_groups):
+        index = df[df["groups"] == m].index
+        transactions_list.append([df2.iloc[n].to_dict() for n in index])
+    return transactions_list
+
+
+def timed(func, *args):
+    """
+    Returns wall time in seconds of a single call to func
+    """
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def measured(func, *args):
+    """
+    Returns wall time in seconds and peak traced memory in bytes of a single call to func
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def legacy_vectorize(narrations):
+    """
+    Previous vectorization path: narrations are processed, then processed again by the analyzer \
+    whose string output is split into characters, so ngram_range had no effect
+    """
+    normalizer = benchmark_normalizer()
+    narration_list = [normalizer(text) for text in narrations]
+    return TfidfVectorizer(analyzer=normalizer, ngram_range=(1, 3)).fit_transform(narration_list)
+
+
+def current_vectorize(narrations, backend):
+    """
+    Current vectorization path: narrations are processed once and split into word n-grams
+    """
+    normalizer = benchmark_normalizer()
+    return vectorize_narrations([normalizer(text) for text in narrations], backend=backend)
+
+
+def bench_assembly(sizes, legacy_limit):
+    """
+    Times group assembly for each statement size and prints one row per size
+    :param sizes: statement sizes :type list
+    :param legacy_limit: largest size the legacy assembly is run for :type int
+    """
+    print(f"{'rows':>8} {'groups':>8} {'legacy_s':>10} {'vectorized_s':>13} {'us/row':>8}")
+    for n_rows in sizes:
+        columns, labels, n_groups = synthetic_columns(n_rows)
+        legacy = f"{timed(legacy_assemble_groups, labels, columns, n_groups):10.3f}" \
+            if n_rows <= legacy_limit else f"{'-':>10}"
+        vectorized = timed(assemble_groups, labels, columns, n_groups)
+        print(f"{n_rows:>8} {n_groups:>8} {legacy} {vectorized:13.4f} {vectorized / n_rows * 1e6:8.2f}")
+
+
+def bench_normalize(sizes, legacy_limit):
+    """
+    Times narration preprocessing on the sample statement and for each statement size, printing one row each. \
+    The legacy preprocessing needs the nltk corpora and is skipped without them
+    :param sizes: statement sizes :type list
+    :param legacy_limit: largest size the legacy preprocessing is run for :type int
+    """
+    print(f"{'rows':>8} {'legacy_s':>10} {'cached_s':>10} {'speedup':>8} {'narration_hit_rate':>19}")
+    statements = [("sample", [transaction["narration"] for transaction in sample_statement()])]
+    statements += [(n_rows, synthetic_narrations(n_rows)) for n_rows in sizes]
+    for label, narrations in statements:
+        n_rows = len(narrations)
+        normalizer = benchmark_normalizer()
+        cached = timed(lambda: [normalizer(text) for text in narrations])
+        info = normalizer.cache_info()["narrations"]
+        hit_rate = info["hits"] / max(info["hits"] + info["misses"], 1)
+        # the legacy preprocessing needs the nltk corpora
+        if n_rows <= legacy_limit and corpora_available():
+            legacy = timed(lambda: [legacy_text_process(text) for text in narrations])
+            legacy_cells = f"{legacy:10.3f} {cached:10.4f} {legacy / cached:8.1f}"
+        else:
+            legacy_cells = f"{'-':>10} {cached:10.4f} {'-':>8}"
+        print(f"{label:>8} {legacy_cells} {hit_rate:19.2f}")
+
+
+def store_vectorize(narrations, store):
+    """
+    Feature store path: narrations are processed once and transformed with the precomputed vocabulary
+    """
+    normalizer = benchmark_normalizer()
+    return store.transform([normalizer(text) for text in narrations])
+
+
+def bench_vectorize(sizes, history_rows, clustering, max_clusters):
+    """
+    Times vectorization, including narration preprocessing, and clustering of the features for each statement size \
+    and backend, since clustering keeps dense centroids as wide as the features
+    :param sizes: statement sizes :type list
+    :param history_rows: number of historical narrations the feature store is built from :type int
+    :param clustering: "kmeans" or "minibatch" :type str
+    :param max_clusters: upper bound on the number of clusters, None for no bound :type int
+    """
+    directory = tempfile.mkdtemp()
+    store = FeatureStore.build(synthetic_narrations(history_rows, seed=1), os.path.join(directory, "features.store"),
+                               normalizer=benchmark_normalizer())
+    print(f"{'rows':>8} {'path':>8} {'vectorize_s':>12} {'cluster_s':>10} {'peak_MiB':>9} {'features':>9}")
+    for n_rows in sizes:
+        narrations = synthetic_narrations(n_rows)
+        n_clusters = choose_n_clusters(n_rows, max_clusters=max_clusters)
+        paths = {"legacy": legacy_vectorize,
+                 "tfidf": lambda texts: current_vectorize(texts, "tfidf"),
+                 "hashing": lambda texts: current_vectorize(texts, "hashing"),
+                 "store": lambda texts: store_vectorize(texts, store)}
+        for name, path in paths.items():
+            # tracing slows allocation heavy code down, so time and memory are taken from separate runs
+            start = time.perf_counter()
+            features = path(narrations)
+            vectorized = time.perf_counter() - start
+            clustered = timed(cluster_features, features, n_clusters, clustering)
+            peak = measured(lambda: cluster_features(path(narrations), n_clusters, clustering))[1]
+            print(f"{n_rows:>8} {name:>8} {vectorized:12.3f} {clustered:10.3f} {peak / 2 ** 20:9.1f} "
+                  f"{features.shape[1]:>9}")
+
+
+def clustering_options(max_clusters):
+    """
+    Clustering configurations compared by bench_cluster
+    :param max_clusters: cap used by the capped configurations :type int
+    :return: configuration name mapped to (algorithm, max_clusters, dedup) :type dict
+    """
+    return {"kmeans": ("kmeans", None, False),
+            "minibatch": ("minibatch", None, False),
+            "minibatch_capped": ("minibatch", max_clusters, False),
+            "kmeans_dedup": ("kmeans", None, True),
+            "minibatch_dedup": ("minibatch", None, True),
+            "minibatch_capped_dedup": ("minibatch", max_clusters, True)}
+
+
+def run_clustering(narrations, algorithm, max_clusters, dedup):
+    """
+    Vectorizes and clusters normalized narrations the way transaction_grouping does
+    """
+    n_clusters = choose_n_clusters(len(narrations), max_clusters=max_clusters)
+    if dedup:
+        distinct, inverse, counts = deduplicate(narrations)
+        features = vectorize_narrations(distinct)
+        return cluster_features(features, min(n_clusters, len(distinct)), algorithm, sample_weight=counts)[inverse]
+    return cluster_features(vectorize_narrations(narrations), n_clusters, algorithm)
+
+
+def bench_cluster(sizes, legacy_limit, max_clusters):
+    """
+    Times vectorization and clustering for each statement size and clustering configuration
+    :param sizes: statement sizes :type list
+    :param legacy_limit: largest size options without a cap or deduplication are run for :type int
+    :param max_clusters: cap used by the capped configurations :type int
+    """
+    print(f"{'rows':>8} {'option':>24} {'seconds':>9} {'peak_MiB':>9}")
+    for n_rows in sizes:
+        normalizer = benchmark_normalizer()
+        narrations = [normalizer(text) for text in synthetic_narrations(n_rows)]
+        for name, (algorithm, cap, dedup) in clustering_options(max_clusters).items():
+            # without a cap or deduplication k grows with n, so the cost grows quadratically
+            if cap is None and not dedup and n_rows > legacy_limit:
+                print(f"{n_rows:>8} {name:>24} {'-':>9} {'-':>9}")
+                continue
+            elapsed = timed(run_clustering, narrations, algorithm, cap, dedup)
+            peak = measured(run_clustering, narrations, algorithm, cap, dedup)[1]
+            print(f"{n_rows:>8} {name:>24} {elapsed:9.3f} {peak / 2 ** 20:9.1f}")
+
+
+def bench_fast_path(sizes, max_clusters):
+    """
+    Times transaction_grouping with and without the canonical fast path for each statement size
+    :param sizes: statement sizes :type list
+    :param max_clusters: cap on the number of clusters fitted on the remaining narrations :type int
+    """
+    print(f"{'rows':>8} {'bucketed':>9} {'clustering_s':>13} {'fast_path_s':>12}")
+    for n_rows in sizes:
+        statement = synthetic_statement(n_rows)
+        labels = canonical_buckets([transaction["narration"] for transaction in statement])[0]
+        options = {"clustering": "minibatch", "max_clusters": max_clusters}
+        clustering = timed(lambda: transaction_grouping(statement, normalizer=benchmark_normalizer(), **options))
+        fast_path = timed(lambda: transaction_grouping(statement, fast_path=True, normalizer=benchmark_normalizer(),
+                                                       **options))
+        print(f"{n_rows:>8} {np.mean(labels >= 0):9.2f} {clustering:13.3f} {fast_path:12.3f}")
+
+
+def sample_statement():
+    """
+    :return: the sample statement assigned to response_list in mono.py :type list of dict
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mono.py")) as file:
+        tree = ast.parse(file.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and any(getattr(target, "id", None) == "response_list"
+                                                for target in node.targets):
+            return ast.literal_eval(node.value)
+    raise LookupError("no sample statement in mono.py")
+
+
+def bench_lsh(sizes, legacy_limit, max_clusters):
+    """
+    Compares LSH grouping with KMeans, first on the sample statement then on synthetic statements of each size. \
+    Agreement with KMeans is measured by adjusted Rand index and normalized mutual information
+    :param sizes: statement sizes :type list
+    :param legacy_limit: largest size KMeans is run for :type int
+    :param max_clusters: cap on the number of MiniBatchKMeans clusters :type int
+    """
+    from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+    print(f"{'rows':>8} {'engine':>10} {'seconds':>9} {'groups':>7} {'ari':>6} {'nmi':>6}")
+    engines = {"kmeans": {"clustering": "kmeans"},
+               "minibatch": {"clustering": "minibatch", "max_clusters": max_clusters},
+               "lsh": {"clustering": "lsh"}}
+    for n_rows in [None] + sizes:
+        statement = sample_statement() if n_rows is None else synthetic_statement(n_rows)
+        narrations = [transaction["narration"] for transaction in statement]
+        dates = [transaction["date"] for transaction in statement]
+        reference = None
+        for engine, options in engines.items():
+            if engine == "kmeans" and len(statement) > legacy_limit:
+                continue
+            normalizer = benchmark_normalizer()
+            start = time.perf_counter()
+            labels, n_groups, _ = label_transactions(narrations, dates, normalizer=normalizer, **options)
+            elapsed = time.perf_counter() - start
+            if engine == "kmeans":
+                reference = labels
+            scores = f"{'-':>6} {'-':>6}" if reference is None or engine == "kmeans" else \
+                f"{adjusted_rand_score(reference, labels):6.2f} {normalized_mutual_info_score(reference, labels):6.2f}"
+            print(f"{'sample' if n_rows is None else n_rows:>8} {engine:>10} {elapsed:9.3f} {n_groups:>7} {scores}")
+
+
+# run in a fresh interpreter to time importing the app and grouping the first statement, passed as argv[1], \
+# argv[2] is "offline" when the nltk corpora aren't installed
+STARTUP_SCRIPT = """
+import json, os, sys, time
+start = time.perf_counter()
+import mono_api
+imported = time.perf_counter()
+import mono
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def normalizer():
+    # created on first use, so building it counts towards warm-up or the first statement like the default one
+    if sys.argv[2] != "offline":
+        return None
+    from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+    return mono.NarrationNormalizer(stop_words=ENGLISH_STOP_WORDS, lemmatize=str)
+
+if os.environ.get("MONO_WARM_UP"):
+    mono.warm_up(normalizer())
+warmed = time.perf_counter()
+mono.transaction_grouping(json.loads(sys.argv[1]), normalizer=normalizer())
+print(json.dumps({"import_s": imported - start, "warm_up_s": warmed - imported,
+                  "first_statement_s": time.perf_counter() - warmed}))
+"""
+
+
+def bench_startup(repeats):
+    """
+    Times worker cold start in fresh interpreters, with and without the warm-up hook
+    :param repeats: number of interpreters started for each mode :type int
+    """
+    print(f"{'mode':>8} {'import_s':>9} {'warm_up_s':>10} {'first_statement_s':>18}")
+    directory = os.path.dirname(os.path.abspath(__file__))
+    statement = json.dumps(synthetic_statement(20))
+    corpora = "nltk" if corpora_available() else "offline"
+    command = [sys.executable, "-c", STARTUP_SCRIPT, statement, corpora]
+    for mode, extra_env in (("cold", {}), ("warm_up", {"MONO_WARM_UP": "1"})):
+        env = dict(os.environ, **extra_env)
+        runs = [json.loads(subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True,
+                                          check=True).stdout.splitlines()[-1])
+                for _ in range(repeats)]
+        print(f"{mode:>8} " + " ".join(f"{np.median([run[key] for run in runs]):{width}.3f}" for key, width in
+                                       (("import_s", 9), ("warm_up_s", 10), ("first_statement_s", 18))))
+
+
+def bench_batch(n_accounts, account_size, worker_counts):
+    """
+    Measures batch grouping throughput in accounts per second for each process pool size
+    :param n_accounts: number of accounts in the batch :type int
+    :param account_size: number of transactions of each account :type int
+    :param worker_counts: process pool sizes :type list
+    """
+    accounts = {f"account{i}": synthetic_statement(account_size, seed=i) for i in range(n_accounts)}
+    # the normalizer is pickled to the workers, so they don't need the nltk corpora either
+    normalizer = benchmark_normalizer()
+    print(f"{'workers':>8} {'seconds':>9} {'accounts/s':>11}")
+    for n_workers in worker_counts:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=warm_up, initargs=(normalizer,)) as executor:
+            # the first small batch starts and warms up every worker before timing
+            batch_transaction_grouping(dict(list(accounts.items())[:n_workers]), executor, n_workers,
+                                       normalizer=normalizer)
+            elapsed = timed(lambda: batch_transaction_grouping(accounts, executor, n_workers, normalizer=normalizer))
+        print(f"{n_workers:>8} {elapsed:9.3f} {n_accounts / elapsed:11.1f}")
+
+
+def dict_response(body, options):
+    """
+    Dictionary path: the statement is decoded into a dict per transaction, grouped and encoded with json
+    """
+    return json.dumps({"status": "success", "data": transaction_grouping(json.loads(body), **options)}).encode()
+
+
+def columnar_response(body, options):
+    """
+    Columnar path: the statement is read into TransactionColumns and the response encoded straight from the columns
+    """
+    transactions = json_loads(body)
+    columns = TransactionColumns.from_records(transactions)
+    del transactions
+    groups = b",".join([b'"%b":%b' % (name.encode(), group) for name, group in encode_groups(columns, **options)])
+    return b'{"status":"success","data":{%b}}' % groups
+
+
+def bench_columnar(sizes, max_clusters):
+    """
+    Times and traces peak memory of a request body going through the dictionary and the columnar path
+    :param sizes: statement sizes :type list
+    :param max_clusters: upper bound on the number of clusters :type int
+    """
+    print(f"{'rows':>8} {'dict_s':>8} {'dict_MiB':>9} {'columnar_s':>11} {'columnar_MiB':>13}")
+    for n_rows in sizes:
+        body = json.dumps(synthetic_statement(n_rows)).encode()
+        row = []
+        for respond in (dict_response, columnar_response):
+            options = {"normalizer": benchmark_normalizer(), "clustering": "minibatch", "max_clusters": max_clusters}
+            seconds = timed(respond, body, options)
+            # the traced run gets a fresh normalizer so it doesn't only hit the first run's cache
+            options["normalizer"] = benchmark_normalizer()
+            row += [seconds, measured(respond, body, options)[1] / 2 ** 20]
+        print(f"{n_rows:>8} {row[0]:8.3f} {row[1]:9.2f} {row[2]:11.3f} {row[3]:13.2f}")
+
+
+def environment():
+    """
+    :return: versions and machine details stored with pipeline results so runs can be compared :type dict
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "sklearn": sklearn.__version__, "machine": platform.machine(), "system": platform.system(),
+            "cpus": os.cpu_count(), "nltk_corpora": corpora_available()}
+
+
+def profile_pipeline(statement, vectorizer, clustering, max_clusters):
+    """
+    Runs each stage of transaction grouping once for timing and once under tracemalloc for peak memory
+    :param statement: transactions :type list of dict
+    :param vectorizer: "tfidf" or "hashing" :type str
+    :param clustering: "kmeans" or "minibatch" :type str
+    :param max_clusters: upper bound on the number of clusters, None for no bound :type int
+    :return: stage name mapped to (seconds, peak traced bytes) :type dict
+    """
+    columns = {name: [transaction[name] for transaction in statement]
+               for name in ("narration", "amount", "type", "date")}
+    n_clusters = choose_n_clusters(len(statement), max_clusters=max_clusters)
+    results = {}
+
+    def run(stage, func):
+        # tracing slows allocation heavy code down, so time and memory are taken from separate runs
+        start = time.perf_counter()
+        value = func()
+        results[stage] = (time.perf_counter() - start, measured(func)[1])
+        return value
+
+    def normalize():
+        # a fresh normalizer for each run, so the traced run doesn't only hit the first run's cache
+        normalizer = benchmark_normalizer()
+        return [normalizer(text) for text in columns["narration"]]
+
+    narrations = run("normalization", normalize)
+    features = run("vectorization", lambda: vectorize_narrations(narrations, backend=vectorizer))
+    labels = run("clustering", lambda: cluster_features(features, n_clusters, clustering))
+    run("assembly", lambda: assemble_groups(labels, columns, n_clusters))
+    run("date_stats", lambda: date_gap_statistics(columns["date"], labels, n_clusters))
+    return results
+
+
+def bench_pipeline(sizes, vectorizer, clustering, max_clusters, json_path):
+    """
+    Times every stage of the grouping pipeline for each statement size, optionally writing the results as JSON
+    :param sizes: statement sizes :type list
+    :param vectorizer: "tfidf" or "hashing" :type str
+    :param clustering: "kmeans" or "minibatch" :type str
+    :param max_clusters: upper bound on the number of clusters, None for no bound :type int
+    :param json_path: file the results are written to, None to only print them :type str
+    """
+    records = []
+    print(f"{'rows':>8} {'stage':>14} {'seconds':>9} {'peak_MiB':>9}")
+    for n_rows in sizes:
+        statement = synthetic_statement(n_rows)
+        for stage, (seconds, peak) in profile_pipeline(statement, vectorizer, clustering, max_clusters).items():
+            records.append({"rows": n_rows, "stage": stage, "seconds": seconds, "peak_bytes": peak})
+            print(f"{n_rows:>8} {stage:>14} {seconds:9.4f} {peak / 2 ** 20:9.2f}")
+    if json_path is not None:
+        with open(json_path, "w") as file:
+            json.dump({"environment": environment(),
+                       "options": {"vectorizer": vectorizer, "clustering": clustering, "max_clusters": max_clusters},
+                       "results": records}, file, indent=2)
+
+
+if __name__ == "__main__":
+    # benchmarks never download corpora, see benchmark_normalizer
+    os.environ.setdefault("MONO_OFFLINE", "1")
+    parser = argparse.ArgumentParser(description="Benchmarks stages of the transaction grouping pipeline")
+    parser.add_argument("stage", choices=["assembly", "normalize", "vectorize", "cluster", "fast_path", "startup",
+                                          "batch", "pipeline", "columnar", "lsh"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 10000, 20000, 100000])
+    parser.add_argument("--legacy-limit", type=int, default=5000,
+                        help="largest statement size the legacy implementation is run for")
+    parser.add_argument("--max-clusters", type=int, default=500,
+                        help="cluster cap used by the capped clustering options")
+    parser.add_argument("--repeats", type=int, default=5, help="interpreters started by the startup stage")
+    parser.add_argument("--accounts", type=int, default=200, help="accounts grouped by the batch stage")
+    parser.add_argument("--account-size", type=int, default=100, help="transactions per account in the batch stage")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}), help="process pool sizes for the batch stage")
+    parser.add_argument("--vectorizer", choices=["tfidf", "hashing"], default="tfidf",
+                        help="vectorizer used by the pipeline stage")
+    parser.add_argument("--clustering", choices=["kmeans", "minibatch"], default="minibatch",
+                        help="clustering used by the pipeline and vectorize stages")
+    parser.add_argument("--history", type=int, default=20000,
+                        help="historical narrations the vectorize stage builds its feature store from")
+    parser.add_argument("--json", help="file the pipeline stage writes its results to")
+    args = parser.parse_args()
+    if args.stage == "assembly":
+        bench_assembly(args.sizes, args.legacy_limit)
+    elif args.stage == "normalize":
+        bench_normalize(args.sizes, args.legacy_limit)
+    elif args.stage == "vectorize":
+        bench_vectorize(args.sizes, args.history, args.clustering, args.max_clusters)
+    elif args.stage == "cluster":
+        bench_cluster(args.sizes, args.legacy_limit, args.max_clusters)
+    elif args.stage == "fast_path":
+        bench_fast_path(args.sizes, args.max_clusters)
+    elif args.stage == "startup":
+        bench_startup(args.repeats)
+    elif args.stage == "batch":
+        bench_batch(args.accounts, args.account_size, args.workers)
+    elif args.stage == "pipeline":
+        bench_pipeline(args.sizes, args.vectorizer, args.clustering, args.max_clusters, args.json)
+    elif args.stage == "columnar":
+        bench_columnar(args.sizes, args.max_clusters)
+    elif args.stage == "lsh":
+        bench_lsh(args.sizes, args.legacy_limit, args.max_clusters)
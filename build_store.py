@@ -0,0 +1,29 @@
+import argparse
+import json
+from mono import FeatureStore
+
+
+def read_narrations(paths):
+    """
+    Reads narrations from statement files, each a JSON list of transactions or one transaction per line
+    :param paths: statement files :type list of str
+    :return: generator of narrations
+    """
+    for path in paths:
+        with open(path) as file:
+            text = file.read()
+        try:
+            transactions = json.loads(text)
+        except ValueError:
+            transactions = [json.loads(line) for line in text.splitlines() if line.strip()]
+        for transaction in transactions:
+            yield transaction["narration"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the feature store transaction grouping vectorizes with")
+    parser.add_argument("statements", nargs="+", help="historical statement files, JSON lists or NDJSON")
+    parser.add_argument("--output", default="features.store", help="file the store is written to")
+    args = parser.parse_args()
+    store = FeatureStore.build(read_narrations(args.statements), args.output)
+    print(f"{args.output}: {len(store)} terms, {len(store.narration_hashes)} narrations, build {store.build_id}")
@@ -1,15 +1,141 @@
-import pandas as pd
+import hashlib
+import json
+import mmap
 import numpy as np
+import os
+import pickle
 import re
-from datetime import datetime
-from sklearn.cluster import KMeans
-import nltk
-nltk.download('omw-1.4')
-nltk.download("stopwords")
-nltk.download('wordnet')
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-from sklearn.feature_extraction.text import TfidfVectorizer
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from json.encoder import encode_basestring
+# nltk and sklearn are imported where they are first used so that importing this module stays fast
+try:
+    import orjson
+except ImportError:  # orjson only speeds up decoding, json is used without it
+    orjson = None
+
+# nltk resources used by the narration normalizer
+NLTK_CORPORA = {"omw-1.4": "corpora/omw-1.4", "stopwords": "corpora/stopwords", "wordnet": "corpora/wordnet"}
+# corpora bundled with the app are looked up before nltk's default locations
+BUNDLED_NLTK_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nltk_data")
+
+# words containing digits (dates, reference ids) and month names are dropped when canonicalizing narrations
+CANONICAL_NOISE = re.compile(r"\b(?:\w*\d\w*|jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?"
+                             r"|aug(?:ust)?|sept?(?:ember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\b", re.IGNORECASE)
+CANONICAL_WORDS = re.compile("[a-zA-Z]+")
+
+# small statement used to prime corpora, models and caches in warm_up
+WARM_UP_STATEMENT = [{"narration": "-062768- -327662-BLACKBELL RESTAURANT LA  LANG", "amount": 500000,
+                      "type": "debit", "date": "2022-02-10T14:06:00.000Z"},
+                     {"narration": "USSD -044502- -327662-BLACKBELL RESTAURANT LA  LANG", "amount": 100000,
+                      "type": "debit", "date": "2022-03-01T14:06:00.000Z"},
+                     {"narration": "-003894- -118817-CHICKEN REPUBLIC LA  LANG", "amount": 250000,
+                      "type": "debit", "date": "2022-01-10T14:06:00.000Z"},
+                     {"narration": "SMS Notification Charge Mar 2022", "amount": 12000,
+                      "type": "debit", "date": "2022-03-27T14:27:29.000Z"}]
+
+
+def env_flag(name):
+    """
+    :param name: environment variable :type str
+    :return: True if the variable is set to anything other than an empty string or 0 :type bool
+    """
+    return os.environ.get(name, "") not in ("", "0")
+
+
+@lru_cache(maxsize=None)
+def ensure_corpora():
+    """
+    Makes the nltk corpora available, looking in the bundled nltk_data directory, $NLTK_DATA and nltk's \
+    default locations. Only missing corpora are downloaded, and never if MONO_OFFLINE is set
+    """
+    import nltk
+    if os.path.isdir(BUNDLED_NLTK_DATA) and BUNDLED_NLTK_DATA not in nltk.data.path:
+        nltk.data.path.insert(0, BUNDLED_NLTK_DATA)
+    for name, resource in NLTK_CORPORA.items():
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            if env_flag("MONO_OFFLINE"):
+                raise LookupError(f"nltk corpus {name} not found and MONO_OFFLINE is set, "
+                                  f"install it into {BUNDLED_NLTK_DATA}") from None
+            nltk.download(name)
+
+
+class NarrationNormalizer:
+    """
+    Cleans and preprocesses narrations. Stopwords and the regex are prepared once, lemmatized tokens \
+    and whole narrations are kept in LRU caches since bank narrations repeat heavily
+    :param token_cache_size: number of lemmatized tokens to cache, None for unbounded :type int
+    :param narration_cache_size: number of processed narrations to cache, None for unbounded :type int
+    :param stop_words: words to drop, nltk's english stopwords if None :type iterable of str
+    :param lemmatize: function lemmatizing a lower case word, nltk's WordNet lemmatizer if None :type callable
+    """
+
+    def __init__(self, token_cache_size=8192, narration_cache_size=65536, stop_words=None, lemmatize=None):
+        if stop_words is None or lemmatize is None:
+            ensure_corpora()
+        if stop_words is None:
+            from nltk.corpus import stopwords
+            stop_words = stopwords.words("english")
+        if lemmatize is None:
+            from nltk.stem import WordNetLemmatizer
+            lemmatize = WordNetLemmatizer().lemmatize
+        self.stop_words = frozenset(stop_words)
+        self.non_letters = re.compile("[^a-zA-Z]")
+        self.lemmatize = lru_cache(maxsize=token_cache_size)(lemmatize)
+        self.normalize = lru_cache(maxsize=narration_cache_size)(self._normalize)
+        self.arguments = (token_cache_size, narration_cache_size, self.stop_words, lemmatize)
+
+    def __reduce__(self):
+        # caches can't be pickled, so other processes, e.g. process pool workers, start with empty ones
+        return type(self), self.arguments
+
+    def _normalize(self, text):
+        words = self.non_letters.sub(" ", text).split()
+        return " ".join([self.lemmatize(word.lower()) for word in words if word not in self.stop_words])
+
+    def __call__(self, text):
+        """
+        Cleans and preprocesses text
+        :param text: :type str
+        :return text: :type str
+        """
+        return self.normalize(text)
+
+    def cache_info(self):
+        """
+        :return: hits, misses, maximum size and current size of the token and narration caches :type dict
+        """
+        return {"tokens": self.lemmatize.cache_info()._asdict(),
+                "narrations": self.normalize.cache_info()._asdict()}
+
+    def cache_clear(self):
+        self.lemmatize.cache_clear()
+        self.normalize.cache_clear()
+
+    def fingerprint(self):
+        """
+        :return: digest of the stopwords and lemmatizer, the same for normalizers giving the same output :type str
+        """
+        lemmatize = self.arguments[3]
+        name = f"{getattr(lemmatize, '__module__', '')}.{getattr(lemmatize, '__qualname__', repr(lemmatize))}"
+        return hashlib.sha256(json.dumps([sorted(self.stop_words), name]).encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def default_normalizer():
+    """
+    :return: normalizer shared by calls that don't pass their own :type NarrationNormalizer
+    """
+    return NarrationNormalizer()
 
 
 def text_process(text):
@@ -18,89 +144,1205 @@ def text_process(text):
     :param text:
     :return text: :type str
     """
-    stop_words = stopwords.words("english")
-    lem = WordNetLemmatizer()
-    text = re.sub("[^a-zA-Z]", " ", text)
-    text = text.split()
-    text = [lem.lemmatize(word.lower()) for word in text if not word in stop_words]
-    text = " ".join(text)
-    return text
+    return default_normalizer()(text)
+
+
+def group_slices(labels, n_groups):
+    """
+    Sorts the labels once and yields the row indices of each group
+    :param labels: group label of each transaction :type array-like of int
+    :param n_groups: number of groups, groups without transactions give an empty list :type int
+    :return: generator of lists of row indices in their original order, one for each group
+    """
+    labels = np.asarray(labels)
+    # stable sort keeps transactions in their original order within each group
+    order = np.argsort(labels, kind="stable").tolist()
+    ends = np.cumsum(np.bincount(labels, minlength=n_groups)).tolist()
+    for start, end in zip([0] + ends[:-1], ends):
+        yield order[start:end]
+
+
+def iter_groups(labels, columns, n_groups):
+    """
+    Yields per-group lists of transaction dictionaries one group at a time, sorting the labels only once
+    :param labels: group label of each transaction :type array-like of int
+    :param columns: column name mapped to its list of values, in the same order as labels :type dict
+    :param n_groups: number of groups, groups without transactions give an empty list :type int
+    :return: generator of lists of transaction dictionaries, one for each group
+    """
+    names = list(columns)
+    values = [columns[name] for name in names]
+    for rows in group_slices(labels, n_groups):
+        yield [dict(zip(names, [column[i] for column in values])) for i in rows]
+
+
+def assemble_groups(labels, columns, n_groups):
+    """
+    Splits transaction columns into per-group lists of transaction dictionaries in a single pass
+    :param labels: group label of each transaction :type array-like of int
+    :param columns: column name mapped to its list of values, in the same order as labels :type dict
+    :param n_groups: number of groups, groups without transactions give an empty list :type int
+    :return: list holding a list of transaction dictionaries for each group :type list
+    """
+    return list(iter_groups(labels, columns, n_groups))
+
+
+def parse_days(dates):
+    """
+    Parses ISO formatted dates in one go, the first 10 characters hold the day
+    :param dates: ISO formatted transaction dates, or an already parsed datetime64 array :type list of str
+    :return: days since 1970-01-01 :type array of int64
+    """
+    if isinstance(dates, np.ndarray) and dates.dtype.kind == "M":
+        return dates.astype("datetime64[D]").astype(np.int64)
+    return np.asarray(dates, dtype="U10").astype("datetime64[D]").astype(np.int64)
+
+
+def date_gap_statistics(dates, labels, n_groups, statistics=("mean",), sort_by_date=False):
+    """
+    Computes statistics of the number of days between consecutive transactions of each group
+    :param dates: ISO formatted transaction dates or a datetime64 array, see parse_days :type list of str
+    :param labels: group label of each transaction :type array-like of int
+    :param n_groups: number of groups :type int
+    :param statistics: any of "mean", "median" and "std" :type tuple
+    :param sort_by_date: sort transactions in each group by date before taking differences :type bool
+    :return: statistic name mapped to an array holding its value for each group, \
+    groups with less than two transactions get zero :type dict
+    """
+    labels = np.asarray(labels)
+    days = parse_days(dates)
+    if sort_by_date:
+        order = np.lexsort((days, labels))
+    else:
+        # stable sort keeps transactions in their original order within each group
+        order = np.argsort(labels, kind="stable")
+    labels, days = labels[order], days[order]
+
+    # differences between neighbouring transactions, dropping those that cross into the next group
+    same_group = labels[1:] == labels[:-1]
+    gaps = np.abs(np.diff(days))[same_group].astype(np.float64)
+    gap_labels = labels[1:][same_group]
+    counts = np.bincount(gap_labels, minlength=n_groups)
+    has_gaps = counts > 0
+    safe_counts = np.maximum(counts, 1)
+
+    result = {}
+    mean = np.bincount(gap_labels, weights=gaps, minlength=n_groups) / safe_counts
+    for statistic in statistics:
+        if statistic == "mean":
+            result["mean"] = mean
+        elif statistic == "std":
+            mean_of_squares = np.bincount(gap_labels, weights=gaps ** 2, minlength=n_groups) / safe_counts
+            result["std"] = np.sqrt(np.maximum(mean_of_squares - mean ** 2, 0))
+        elif statistic == "median":
+            result["median"] = np.zeros(n_groups)
+            if len(gaps):
+                # gaps sorted within each group, the median sits in the middle of each group's segment
+                sorted_gaps = gaps[np.lexsort((gaps, gap_labels))]
+                starts = np.cumsum(counts) - counts
+                lower = sorted_gaps[np.minimum(starts + (safe_counts - 1) // 2, len(gaps) - 1)]
+                upper = sorted_gaps[np.minimum(starts + safe_counts // 2, len(gaps) - 1)]
+                result["median"] = np.where(has_gaps, (lower + upper) / 2, 0)
+        else:
+            raise ValueError(f"unknown statistic: {statistic}")
+    return result
+
+
+# narrations are already cleaned and lowercased, so they only need splitting into words
+VECTORIZER_OPTIONS = {"tokenizer": str.split, "token_pattern": None, "lowercase": False, "ngram_range": (1, 3)}
+
+
+# columns of hashed features, clustering keeps dense centroids of this width so it has to stay small
+HASHING_FEATURES = 2 ** 12
+
+
+def make_vectorizer(backend="tfidf", n_features=HASHING_FEATURES):
+    """
+    Vectorizer turning normalized narrations into word 1 to 3-gram features
+    :param backend: "tfidf" fits a vocabulary and idf weights, "hashing" hashes n-grams into \
+    n_features columns and keeps no vocabulary so memory stays bounded :type str
+    :param n_features: number of columns used by the hashing backend :type int
+    :return: unfitted sklearn vectorizer producing l2 normalized rows
+    """
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
+    if backend == "tfidf":
+        return TfidfVectorizer(**VECTORIZER_OPTIONS)
+    if backend == "hashing":
+        return HashingVectorizer(n_features=n_features, alternate_sign=False, **VECTORIZER_OPTIONS)
+    raise ValueError(f"unknown vectorizer backend: {backend}")
+
+
+def vectorize_narrations(narrations, backend="tfidf", n_features=HASHING_FEATURES):
+    """
+    Turns normalized narrations into a sparse matrix of word 1 to 3-gram features
+    :param narrations: narrations already processed by a NarrationNormalizer :type list of str
+    :param backend: "tfidf" or "hashing", see make_vectorizer :type str
+    :param n_features: number of columns used by the hashing backend :type int
+    :return: l2 normalized sparse matrix with one row per narration
+    """
+    return make_vectorizer(backend, n_features).fit_transform(narrations)
+
+
+def deduplicate(narrations):
+    """
+    Collapses identical narrations so each one is vectorized and clustered once
+    :param narrations: normalized narrations :type list of str
+    :return: (distinct narrations, index of each narration in the distinct list, \
+    number of times each distinct narration occurs) :type tuple
+    """
+    positions = {}
+    inverse = np.fromiter((positions.setdefault(text, len(positions)) for text in narrations),
+                          dtype=np.intp, count=len(narrations))
+    return list(positions), inverse, np.bincount(inverse, minlength=len(positions))
+
+
+def text_hashes(texts):
+    """
+    :param texts: strings to hash :type list of str
+    :return: stable 64 bit hash of each string, the same in every process :type array of uint64
+    """
+    digests = b"".join([hashlib.blake2b(text.encode(), digest_size=8).digest() for text in texts])
+    return np.frombuffer(digests, dtype="<u8")
+
+
+def sorted_lookup(keys, hashes):
+    """
+    :param keys: sorted hashes of a lookup table :type array of uint64
+    :param hashes: hashes to look up :type array of uint64
+    :return: position of each hash in keys, -1 where it is missing :type array of int
+    """
+    positions = np.searchsorted(keys, hashes)
+    found = positions < len(keys)
+    found[found] = keys[positions[found]] == hashes[found]
+    return np.where(found, positions, -1)
+
+
+class FeatureStore:
+    """
+    Read-only tfidf features fitted once on historical narrations: the word 1 to 3-gram vocabulary, its idf \
+    weights and the terms of every historical normalized narration. The arrays live in one file that is \
+    memory-mapped, so all workers on a machine share its pages and vectorizing a statement is transform-only. \
+    Terms and narrations are looked up by a 64 bit hash of their text
+    """
+    MAGIC = b"MONOFS1\n"
+    ARRAYS = ("term_hashes", "idf", "narration_hashes", "narration_indptr", "narration_terms")
+
+    def __init__(self, path):
+        """
+        :param path: file written by build :type str
+        """
+        self.path = path
+        with open(path, "rb") as file:
+            if file.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f"{path} is not a feature store")
+            header_size = int.from_bytes(file.read(8), "little")
+            self.header = json.loads(file.read(header_size))
+            # the mapping stays valid after the file is closed, and replacing the file doesn't change it
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        start = self.data_offset(header_size)
+        for name in self.ARRAYS:
+            spec = self.header["arrays"][name]
+            setattr(self, name, np.frombuffer(self.buffer, dtype=spec["dtype"], count=spec["size"],
+                                              offset=start + spec["offset"]))
+        self.build_id = self.header["build_id"]
+        self.analyzer = None
+
+    def __repr__(self):
+        return f"FeatureStore({self.build_id})"
+
+    def __reduce__(self):
+        # other processes map the file again instead of receiving a copy of the arrays
+        return type(self), (self.path,)
+
+    def __len__(self):
+        return len(self.term_hashes)
+
+    @classmethod
+    def build(cls, narrations, path, normalizer=None):
+        """
+        Fits the vocabulary and idf weights on historical narrations and writes them to path, \
+        replacing the file in one step so workers never load a partial store
+        :param narrations: raw narrations of historical statements :type iterable of str
+        :param path: file path :type str
+        :param normalizer: narration normalizer, the shared default one is used if None :type NarrationNormalizer
+        :return: the written store :type FeatureStore
+        """
+        from sklearn.feature_extraction.text import CountVectorizer
+        normalizer = normalizer or default_normalizer()
+        distinct, inverse, weights = deduplicate([normalizer(text) for text in narrations])
+        counter = CountVectorizer(**VECTORIZER_OPTIONS)
+        try:
+            counts = counter.fit_transform(distinct).tocsr()
+        except ValueError:
+            raise ValueError("no terms in the historical narrations, a feature store needs at least one")
+        terms = counter.get_feature_names_out()
+        term_hashes = text_hashes(terms)
+        order = np.argsort(term_hashes)
+        if np.any(np.diff(term_hashes[order]) == 0):
+            raise ValueError("term hash collision, the feature store can't tell two terms apart")
+        # vocabulary ids are the positions in the sorted hashes, so lookups need no separate id array
+        term_ids = np.empty_like(order)
+        term_ids[order] = np.arange(len(order))
+        # document frequency counts repeated narrations once per occurrence, idf is smoothed like TfidfVectorizer's
+        document_frequency = np.bincount(counts.indices, weights=np.repeat(weights, np.diff(counts.indptr)),
+                                         minlength=len(terms))
+        idf = np.log((1 + len(inverse)) / (1 + document_frequency[order])) + 1
+        narration_hashes = text_hashes(distinct)
+        if len(np.unique(narration_hashes)) < len(distinct):
+            raise ValueError("narration hash collision, the feature store can't tell two narrations apart")
+        rows = counts[np.argsort(narration_hashes)]
+        # repeated n-grams are stored once per occurrence, so term counts are recovered on transform
+        narration_terms = np.repeat(term_ids[rows.indices], rows.data).astype(np.int32)
+        narration_indptr = np.concatenate([[0], np.cumsum(np.asarray(rows.sum(axis=1)).ravel())])
+        arrays = {"term_hashes": term_hashes[order], "idf": idf.astype(np.float64),
+                  "narration_hashes": np.sort(narration_hashes), "narration_indptr": narration_indptr.astype(np.int64),
+                  "narration_terms": narration_terms}
+        cls.write(arrays, path, {"n_documents": len(inverse)})
+        return cls(path)
+
+    @classmethod
+    def write(cls, arrays, path, metadata):
+        """
+        Writes a JSON header followed by the arrays, each aligned to 64 bytes so it can be viewed in place
+        :param arrays: name mapped to a one dimensional array :type dict
+        :param path: file path :type str
+        :param metadata: extra header entries :type dict
+        """
+        arrays = {name: np.ascontiguousarray(values) for name, values in arrays.items()}
+        build_id = hashlib.sha256()
+        specs, offset = {}, 0
+        for name, values in arrays.items():
+            build_id.update(values.tobytes())
+            # offsets are relative to the end of the header
+            specs[name] = {"dtype": values.dtype.str, "size": len(values), "offset": offset}
+            offset += -(-values.nbytes // 64) * 64
+        header = json.dumps({"build_id": build_id.hexdigest()[:16], "arrays": specs, **metadata}).encode()
+        header = header.ljust(cls.data_offset(len(header)) - len(cls.MAGIC) - 8)
+        # every call writes its own temporary file, so concurrent builds can't interleave their bytes
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(cls.MAGIC + len(header).to_bytes(8, "little") + header)
+                for name, values in arrays.items():
+                    file.seek(len(cls.MAGIC) + 8 + len(header) + specs[name]["offset"])
+                    file.write(values.tobytes())
+                file.truncate(len(cls.MAGIC) + 8 + len(header) + offset)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    @classmethod
+    def data_offset(cls, header_size):
+        """
+        :param header_size: length of the JSON header :type int
+        :return: position of the first array in the file, the first 64 byte boundary after the header :type int
+        """
+        return -(-(len(cls.MAGIC) + 8 + header_size) // 64) * 64
+
+    def transform(self, narrations):
+        """
+        Turns normalized narrations into the same l2 normalized tfidf rows a TfidfVectorizer fitted on the \
+        historical narrations would give. Historical narrations are looked up, others are split into n-grams \
+        and terms missing from the vocabulary are dropped
+        :param narrations: narrations already processed by a NarrationNormalizer :type list of str
+        :return: sparse matrix with one row per narration and one column per vocabulary term
+        """
+        from scipy.sparse import csr_matrix
+        from sklearn.preprocessing import normalize
+        rows = sorted_lookup(self.narration_hashes, text_hashes(narrations))
+        known = rows >= 0
+        lengths = np.zeros(len(rows), dtype=np.int64)
+        lengths[known] = self.narration_indptr[rows[known] + 1] - self.narration_indptr[rows[known]]
+        unknown = np.flatnonzero(~known).tolist()
+        if unknown:
+            if self.analyzer is None:
+                from sklearn.feature_extraction.text import CountVectorizer
+                self.analyzer = CountVectorizer(**VECTORIZER_OPTIONS).build_analyzer()
+            ngrams = [self.analyzer(narrations[i]) for i in unknown]
+            term_ids = sorted_lookup(self.term_hashes, text_hashes([term for terms in ngrams for term in terms]))
+            # terms missing from the vocabulary are dropped
+            unknown_rows = np.repeat(unknown, [len(terms) for terms in ngrams])[term_ids >= 0]
+            term_ids = term_ids[term_ids >= 0]
+            lengths[unknown] = np.bincount(unknown_rows, minlength=len(rows))[unknown]
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        # copies the stored terms of every historical narration in one gather
+        positions = np.flatnonzero(np.repeat(known, lengths))
+        indices[positions] = self.narration_terms[positions + np.repeat(self.narration_indptr[rows[known]] -
+                                                                        indptr[:-1][known], lengths[known])]
+        if unknown:
+            # unknown_rows is ascending, so its terms fill the unknown rows' slots in order
+            indices[np.flatnonzero(np.repeat(~known, lengths))] = term_ids
+        features = csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(narrations), len(self)))
+        features.sum_duplicates()
+        features.data *= self.idf[features.indices]
+        return normalize(features, copy=False) if len(narrations) else features
+
+
+@lru_cache(maxsize=None)
+def default_feature_store():
+    """
+    :return: store at MONO_FEATURE_STORE, memory-mapped once per process, None if the variable isn't set \
+    :type FeatureStore
+    """
+    path = os.environ.get("MONO_FEATURE_STORE")
+    return FeatureStore(path) if path else None
+
+
+def choose_n_clusters(n_transactions, ratio=3.2, max_clusters=None):
+    """
+    Number of clusters to fit, one for every `ratio` transactions
+    :param n_transactions: number of transactions or distinct points :type int
+    :param ratio: average number of transactions per cluster :type float
+    :param max_clusters: upper bound on the number of clusters, None for no bound :type int
+    :return: number of clusters :type int
+    """
+    n_clusters = max(1, round(n_transactions / ratio))
+    if max_clusters is not None:
+        n_clusters = min(n_clusters, max_clusters)
+    return n_clusters
+
+
+def cluster_features(features, n_clusters, algorithm="kmeans", sample_weight=None, profile=None):
+    """
+    Clusters the feature matrix of narrations
+    :param features: sparse matrix with one row per narration
+    :param n_clusters: number of clusters :type int
+    :param algorithm: "kmeans" for full Lloyd iterations, "minibatch" for MiniBatchKMeans, \
+    which updates centroids from small random batches and scales to long statements :type str
+    :param sample_weight: weight of each row, e.g. occurrences of deduplicated narrations :type array
+    :param profile: receives the number of iterations run, None to not record it :type GroupingProfile
+    :return: cluster label of each row :type array
+    """
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    if algorithm == "kmeans":
+        model = KMeans(n_clusters=n_clusters, random_state=6)
+    elif algorithm == "minibatch":
+        model = MiniBatchKMeans(n_clusters=n_clusters, random_state=6, batch_size=1024)
+    else:
+        raise ValueError(f"unknown clustering algorithm: {algorithm}")
+    model.fit(features, sample_weight=sample_weight)
+    if profile is not None:
+        profile.count("kmeans_iterations", model.n_iter_)
+    return model.labels_
+
+
+def minhash_signatures(token_lists, n_hashes=64, seed=6, chunk_size=4096):
+    """
+    MinHash signature of each token set, two signatures agree in a position with probability equal to the \
+    Jaccard similarity of their sets
+    :param token_lists: tokens of each narration, each list holding at least one token :type list of list
+    :param n_hashes: signature length :type int
+    :param seed: random seed of the hash functions :type int
+    :param chunk_size: narrations hashed at a time, bounds the memory of the intermediate matrix :type int
+    :return: n_narrations x n_hashes matrix :type array of uint32
+    """
+    rng = np.random.default_rng(seed)
+    # multiply-shift hashing, uint64 products wrap around and the high bits are kept
+    multipliers = rng.integers(1, 2 ** 63, n_hashes, dtype=np.uint64) | np.uint64(1)
+    offsets = rng.integers(0, 2 ** 63, n_hashes, dtype=np.uint64)
+    vocabulary = {}
+    token_ids = [[vocabulary.setdefault(token, len(vocabulary)) for token in tokens] for tokens in token_lists]
+    token_hashes = text_hashes(list(vocabulary))
+    signatures = np.empty((len(token_lists), n_hashes), dtype=np.uint32)
+    for start in range(0, len(token_lists), chunk_size):
+        chunk = token_ids[start:start + chunk_size]
+        ids = np.fromiter((token for tokens in chunk for token in tokens), dtype=np.intp)
+        hashed = ((token_hashes[ids][:, None] * multipliers + offsets) >> np.uint64(32)).astype(np.uint32)
+        bounds = np.cumsum([0] + [len(tokens) for tokens in chunk[:-1]])
+        signatures[start:start + len(chunk)] = np.minimum.reduceat(hashed, bounds, axis=0)
+    return signatures
+
+
+def lsh_groups(narrations, bands=16, rows=4, threshold=0.5, chunk_size=65536):
+    """
+    Groups near-duplicate narrations without vectorizing them: narrations whose MinHash signatures match \
+    in all rows of any band are candidates, candidates whose estimated word Jaccard similarity reaches \
+    threshold are joined, and groups are the connected components. Runs in close to linear time, \
+    the number of groups follows from the narrations
+    :param narrations: normalized narrations :type list of str
+    :param bands: number of signature bands, more bands find less similar candidates :type int
+    :param rows: signature rows in each band, more rows find fewer candidates :type int
+    :param threshold: smallest estimated Jaccard similarity of joined narrations :type float
+    :param chunk_size: candidate pairs verified at a time, bounds memory :type int
+    :return: (group label of each narration, number of groups) :type tuple
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    # narrations without words all get the same signature and land in one group
+    signatures = minhash_signatures([text.split() or [""] for text in narrations], bands * rows)
+    n_narrations = len(narrations)
+    band_key = np.dtype((np.void, signatures.itemsize * rows))
+    pairs = []
+    for band in range(bands):
+        keys = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows]).view(band_key).ravel()
+        # each narration is paired with the first narration of its bucket, enough to connect the bucket
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        leaders = first[inverse.ravel()]
+        members = np.flatnonzero(leaders != np.arange(n_narrations))
+        pairs.append(members * n_narrations + leaders[members])
+    pairs = np.unique(np.concatenate(pairs))
+    sources, targets = pairs // n_narrations, pairs % n_narrations
+    keep = np.zeros(len(pairs), dtype=bool)
+    for start in range(0, len(pairs), chunk_size):
+        end = start + chunk_size
+        agreement = np.count_nonzero(signatures[sources[start:end]] == signatures[targets[start:end]], axis=1)
+        keep[start:end] = agreement >= threshold * signatures.shape[1]
+    graph = coo_matrix((np.ones(np.count_nonzero(keep), dtype=np.int8), (sources[keep], targets[keep])),
+                       shape=(n_narrations, n_narrations))
+    n_groups, labels = connected_components(graph, directed=False)
+    return labels, n_groups
+
+
+def canonicalize(narration):
+    """
+    Strips digits, reference ids and month names from a narration so recurring transactions match exactly
+    :param narration: raw narration :type str
+    :return: upper case words left in the narration :type str
+    """
+    return " ".join(CANONICAL_WORDS.findall(CANONICAL_NOISE.sub(" ", narration))).upper()
+
+
+def canonical_buckets(narrations, min_bucket_size=2):
+    """
+    Buckets narrations with identical canonical forms in a single pass
+    :param narrations: raw narrations :type list of str
+    :param min_bucket_size: canonical forms occurring fewer times are left for clustering :type int
+    :return: (bucket label of each narration, -1 if it is left for clustering, number of buckets) :type tuple
+    """
+    keys, inverse, counts = deduplicate([canonicalize(narration) for narration in narrations])
+    keep = (counts >= min_bucket_size) & np.array([key != "" for key in keys], dtype=bool)
+    bucket_ids = np.full(len(keys), -1, dtype=np.intp)
+    bucket_ids[keep] = np.arange(np.count_nonzero(keep))
+    return bucket_ids[inverse], int(np.count_nonzero(keep))
+
+
+def cluster_narrations(narrations, vectorizer="tfidf", clustering="kmeans", cluster_ratio=3.2,
+                       max_clusters=None, dedup=False, profile=None, feature_store=None):
+    """
+    Vectorizes and clusters normalized narrations, see label_transactions for the parameters
+    :return: (cluster label of each narration, number of clusters) :type tuple
+    """
+    profile = profile or GroupingProfile()
+    if clustering == "lsh":
+        # near-duplicates are joined instead of fitting centroids, so nothing is vectorized and the number of \
+        # groups follows from the narrations rather than cluster_ratio and max_clusters
+        narrations, inverse, _ = deduplicate(narrations)
+        profile.count("distinct_narrations", len(narrations))
+        with profile.stage("clustering"):
+            labels, n_clusters = lsh_groups(narrations)
+        return labels[inverse], n_clusters
+    if not any(text.split() for text in narrations):
+        # no narration has a term to vectorize, e.g. fast path leftovers holding only digits, so they form one group
+        return np.zeros(len(narrations), dtype=np.intp), 1
+    n_clusters = choose_n_clusters(len(narrations), cluster_ratio, max_clusters)
+    weights = inverse = None
+    if dedup:
+        # cluster each distinct narration once, weighted by how often it occurs
+        narrations, inverse, weights = deduplicate(narrations)
+        profile.count("distinct_narrations", len(narrations))
+    # identical narrations always share a cluster, so more clusters than distinct narrations would stay empty
+    n_clusters = min(n_clusters, len(set(narrations)))
+    with profile.stage("vectorization"):
+        if feature_store is not None:
+            x_transformed = feature_store.transform(narrations)
+        else:
+            x_transformed = vectorize_narrations(narrations, backend=vectorizer)
+    with profile.stage("clustering"):
+        labels = cluster_features(x_transformed, n_clusters, clustering, sample_weight=weights, profile=profile)
+    # clusters left without members, e.g. by minibatch, are dropped and the rest numbered consecutively, \
+    # so every group returned has transactions
+    used, labels = np.unique(labels, return_inverse=True)
+    labels = labels.astype(np.intp)
+    return (labels if inverse is None else labels[inverse]), len(used)
 
 
-def transaction_grouping(response_list):
+class GroupingProfile:
+    """
+    Collects the time spent in each stage of grouping along with counters such as rows, clusters and \
+    KMeans iterations. Pass one to transaction_grouping as profile to inspect a run
+    :param callback: called with the stage name and its seconds whenever a stage ends :type callable
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = {}  # stage name mapped to seconds spent in it
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0) + elapsed
+            if self.callback is not None:
+                self.callback(name, elapsed)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        """
+        :return: stage seconds and counters :type dict
+        """
+        return {"stages": dict(self.stages), "counters": dict(self.counters)}
+
+
+def label_transactions(narrations, dates, sort_by_date=False, normalizer=None, vectorizer="tfidf",
+                       clustering="kmeans", cluster_ratio=3.2, max_clusters=None, dedup=False,
+                       fast_path=False, min_bucket_size=2, profile=None, feature_store=None):
+    """
+    Assigns each transaction to a group based on transaction narration
+    :param narrations: raw narration of each transaction :type list of str
+    :param dates: ISO formatted transaction dates or a datetime64 array, see parse_days :type list of str
+    :param sort_by_date: sort transactions in each group by date before computing days between them :type bool
+    :param normalizer: narration normalizer, the shared default one is used if None :type NarrationNormalizer
+    :param vectorizer: "tfidf" or "hashing", see vectorize_narrations :type str
+    :param clustering: "kmeans" or "minibatch", see cluster_features, or "lsh" to join near-duplicate \
+    narrations for very long statements, see lsh_groups :type str
+    :param cluster_ratio: average number of transactions per group, not used by "lsh" :type float
+    :param max_clusters: upper bound on the number of groups, None for no bound, not used by "lsh" :type int
+    :param dedup: collapse identical normalized narrations into weighted points before clustering :type bool
+    :param fast_path: group narrations that only differ in digits, ids and months without clustering, \
+    only the remaining narrations are vectorized and clustered :type bool
+    :param min_bucket_size: smallest number of matching narrations grouped by the fast path :type int
+    :param profile: collects stage timings and counters, see GroupingProfile :type GroupingProfile
+    :param feature_store: precomputed vocabulary and idf weights narrations are transformed with instead of \
+    fitting a vectorizer, vectorizer is then ignored. Defaults to the store at MONO_FEATURE_STORE, \
+    see default_feature_store :type FeatureStore
+    :return: (group label of each transaction, number of groups, \
+    rounded average number of days between transactions of each group) :type tuple
+    """
+    if normalizer is None:
+        normalizer = default_normalizer()
+    if feature_store is None:
+        feature_store = default_feature_store()
+    profile = profile or GroupingProfile()
+    profile.count("rows", len(narrations))
+
+    if fast_path:
+        with profile.stage("fast_path"):
+            labels, n_clusters = canonical_buckets(narrations, min_bucket_size)
+    else:
+        labels, n_clusters = np.full(len(narrations), -1, dtype=np.intp), 0
+    remaining = np.flatnonzero(labels < 0)
+    profile.count("fast_path_rows", len(narrations) - len(remaining))
+    if len(remaining):
+        # clean and preprocess narrations left for the model before clustering them
+        with profile.stage("normalization"):
+            narration_list = [normalizer(narrations[i]) for i in remaining.tolist()]
+        cluster_labels, n_model_clusters = cluster_narrations(narration_list, vectorizer, clustering, cluster_ratio,
+                                                              max_clusters, dedup, profile, feature_store)
+        labels[remaining] = cluster_labels + n_clusters
+        n_clusters += n_model_clusters
+    profile.count("clusters", n_clusters)
+
+    # calculating average number of days btw transactions
+    with profile.stage("date_stats"):
+        avg_days_list = [round(days) for days in
+                         date_gap_statistics(dates, labels, n_clusters, sort_by_date=sort_by_date)["mean"].tolist()]
+    return labels, n_clusters, avg_days_list
+
+
+def iter_transaction_groups(columns, profile=None, **options):
+    """
+    Groups transactions held as columns based on transaction narration, yielding one group at a time
+    :param columns: "narration", "amount", "type" and "date" mapped to lists of equal length :type dict
+    :param profile: collects stage timings and counters, see GroupingProfile :type GroupingProfile
+    :param options: grouping options, see label_transactions
+    :return: generator of (group name, group) pairs, each group holding the average number of days \
+    between its transactions and the transactions
+    """
+    if not columns["narration"]:
+        return
+    profile = profile or GroupingProfile()
+    labels, n_clusters, avg_days_list = label_transactions(columns["narration"], columns["date"],
+                                                           profile=profile, **options)
+
+    # split transactions into groups with a single sort of the cluster labels
+    with profile.stage("assembly"):
+        transactions = iter_groups(labels, {name: columns[name] for name in ("narration", "amount", "type", "date")},
+                                   n_clusters)
+    for i, avg_days in enumerate(avg_days_list):
+        # groups are built lazily, so only the time spent building each one counts towards assembly
+        with profile.stage("assembly"):
+            transactions_list = next(transactions)
+        yield f"group{i+1}", {"average_number_of_days_between_transactions": avg_days,
+                              "transactions": transactions_list}
+
+
+def transaction_grouping(response_list, **options):
     """
     Groups transactions based on transaction narration
     :param response_list: list of dictionary containing transaction data :type list
+    :param options: grouping options, see label_transactions
     :return: grouped transactions along side average number of days between transactions for each group
     """
-    narr_list = []  # list to hold narrations used for display
-    narration_list = []  # list to hold narrations used for training model
-    amount_list = []  # list to hold amount
-    type_list = []  # list to hold transaction type
-    date_list = []  # list to hold transaction date
+    columns = {"narration": [],  # list to hold narrations
+               "amount": [],  # list to hold amount
+               "type": [],  # list to hold transaction type
+               "date": []}  # list to hold transaction date
     for response in response_list:
-        narr_list.append(response["narration"])
-        # clean and preprocess narration before appending
-        narration_list.append(text_process(response["narration"]))
-        amount_list.append(response["amount"])
-        type_list.append(response["type"])
-        date_list.append(response["date"])
-
-    x_transformed = TfidfVectorizer(analyzer=text_process,
-                                    ngram_range=(1, 3)).fit_transform(narration_list)
-    n_clusters = round(x_transformed.shape[0] / 3.2)
-    model = KMeans(n_clusters=n_clusters, random_state=6)
-    model.fit(x_transformed)
-    df = pd.DataFrame({"narration": narr_list, "groups":model.labels_,
-                       "amount": amount_list, "type": type_list,
-                       "date": date_list})
-    # print(df["groups"].groupby(df["narration"]).median()[:8])
-
-    df2 = df.drop(["groups"], axis=1)
-
-    # Getting grouped transactions as list of dictionaries and calculating average number of days btw transactions
-    transactions_list = []  # list to hold grouped transaction dictionaries
-    avg_days_list = []
-
-    for m in range(n_clusters):
-        temp_list = []  # list that holds transaction details before appended into transaction list
-        date_list_2 = []  # list that holds dates in transactions before the mean is computed
-
-        # Get the index of transactions with similar groups
-        index = df[df["groups"] == m].index
-        # loop through  index and append rows as dictionaries to list
-        for n in index:
-            temp_list.append(df2.iloc[n].to_dict())
-
-        # loop through length of "temp_list" to get and calculate average days between transactions
-        for i in range(len(temp_list)):
-            # if loop is at the end, break becuase there is no subsequent date to compute difference.
-            if i == max(range(len(temp_list))):
-                break
-            # convert first 10 strings which are dates
-            d1 = datetime.strptime(temp_list[i]["date"][:10], "%Y-%m-%d")
-            # loop through the remaining parts of temp_list to calculate differences between subsequent dates
-            for ii in range(i+1, len(temp_list)):
-                d2 = datetime.strptime(temp_list[ii]["date"][:10], "%Y-%m-%d")
-                # break inner loop so we are left with the next immediate date
-                break
-            # append the differences in dates
-            date_list_2.append(abs((d1 - d2).days))
-        # if length of date_list_2 is empty due to groups with only one transactions \
-        # (no second date to calculate differences in dates) append zero
-        if len(date_list_2) == 0:
-            date_list_2.append(0)
-        # append the mean of the differences
-        avg_days_list.append(round(np.mean(date_list_2)))
-        # append list of dictionaries
-        transactions_list.append(temp_list)
-
+        for name, column in columns.items():
+            column.append(response[name])
     # group transactions and average number of days between transactions in dictionary
-    group_dict = {}
-    for i  in range(len(avg_days_list)):
-        group_dict[f"group{i+1}"] = {"average_number_of_days_between_transactions": avg_days_list[i],
-                                     "transactions": transactions_list[i]}
-    return group_dict
+    return dict(iter_transaction_groups(columns, **options))
+
+
+def json_loads(data):
+    """
+    :param data: JSON document :type bytes
+    :return: decoded document, with orjson when it is installed
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class TransactionColumns:
+    """
+    Compact columnar statement. Narrations, types and dates are interned, so every distinct value is stored \
+    once and rows hold int codes, and amounts are kept in an int64 array. Dates keep their original text \
+    for output and are parsed to datetime64 once per distinct value
+    """
+    INTERNED = ("narration", "type", "date")
+
+    def __init__(self):
+        self.values = {name: [] for name in self.INTERNED}  # distinct values in order of appearance
+        self.index = {name: {} for name in self.INTERNED}  # distinct value mapped to its code
+        self.codes = {name: array("i") for name in self.INTERNED}  # code of each row
+        self.amount_values = array("q")
+
+    @classmethod
+    def from_records(cls, response_list):
+        """
+        :param response_list: list of dictionary containing transaction data :type list
+        :return: the statement as columns :type TransactionColumns
+        """
+        columns = cls()
+        for response in response_list:
+            columns.append(response["narration"], response["amount"], response["type"], response["date"])
+        return columns
+
+    def append(self, narration, amount, transaction_type, date):
+        for name, value in zip(self.INTERNED, (narration, transaction_type, date)):
+            index = self.index[name]
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(index)
+                self.values[name].append(value)
+            self.codes[name].append(code)
+        self.amount_values.append(amount)
+
+    def __len__(self):
+        return len(self.amount_values)
+
+    def column_codes(self, name):
+        """
+        :param name: "narration", "type" or "date" :type str
+        :return: code of each row, indexing self.values[name] :type array of int
+        """
+        return np.frombuffer(self.codes[name], dtype=np.intc)
+
+    def amounts(self):
+        return np.frombuffer(self.amount_values, dtype=np.int64)
+
+    def days(self):
+        """
+        :return: day of each transaction :type datetime64[D] array
+        """
+        return parse_days(self.values["date"])[self.column_codes("date")].astype("datetime64[D]")
+
+    def narrations(self):
+        """
+        :return: narration of each row, referencing the interned strings rather than copying them :type list
+        """
+        values = self.values["narration"]
+        return [values[code] for code in self.column_codes("narration").tolist()]
+
+
+def label_columns(columns, profile=None, **options):
+    """
+    Assigns each transaction of a columnar statement to a group, see label_transactions
+    :param columns: statement to group :type TransactionColumns
+    :param profile: collects stage timings and counters, see GroupingProfile :type GroupingProfile
+    :param options: grouping options, see label_transactions
+    :return: (group label of each transaction, number of groups, \
+    rounded average number of days between transactions of each group) :type tuple
+    """
+    if not len(columns):
+        return np.zeros(0, dtype=np.intp), 0, []
+    return label_transactions(columns.narrations(), columns.days(), profile=profile, **options)
+
+
+def encode_groups(columns, profile=None, grouping=None, **options):
+    """
+    Groups a columnar statement and JSON encodes each group straight from the columns, \
+    encoding every distinct narration, type and date once instead of building a dictionary per transaction
+    :param columns: statement to group :type TransactionColumns
+    :param profile: collects stage timings and counters, see GroupingProfile :type GroupingProfile
+    :param grouping: result of label_columns for the statement, computed with options if None, \
+    e.g. so grouping errors surface before a response starts streaming :type tuple
+    :param options: grouping options, see label_transactions
+    :return: generator of (group name, group encoded as a JSON object) pairs, \
+    in the same format as transaction_grouping :type generator
+    """
+    if not len(columns):
+        return
+    profile = profile or GroupingProfile()
+    labels, n_clusters, avg_days_list = grouping or label_columns(columns, profile, **options)
+    with profile.stage("assembly"):
+        # orjson.dumps allocates a 1 KiB buffer per call, so the many short strings go through json's C encoder
+        encoded = {name: [encode_basestring(str(value)).encode() for value in columns.values[name]]
+                   for name in columns.INTERNED}
+        narrations, types, dates = [[encoded[name][code] for code in columns.column_codes(name).tolist()]
+                                    for name in columns.INTERNED]
+        amounts = columns.amounts().tolist()
+        slices = group_slices(labels, n_clusters)
+    for i, avg_days in enumerate(avg_days_list):
+        with profile.stage("assembly"):
+            transactions = b",".join([b'{"narration":%b,"amount":%d,"type":%b,"date":%b}'
+                                      % (narrations[row], amounts[row], types[row], dates[row])
+                                      for row in next(slices)])
+            group = b'{"average_number_of_days_between_transactions":%d,"transactions":[%b]}' % (avg_days,
+                                                                                                   transactions)
+        yield f"group{i+1}", group
+
+
+def group_indicator(labels, n_groups):
+    """
+    :param labels: group label of each row :type array of int
+    :param n_groups: number of groups :type int
+    :return: sparse n_groups x len(labels) matrix with a one where a row belongs to a group, \
+    multiplying it with a feature matrix sums the rows of each group
+    """
+    from scipy.sparse import csr_matrix
+    labels = np.asarray(labels)
+    return csr_matrix((np.ones(len(labels)), (labels, np.arange(len(labels)))), shape=(n_groups, len(labels)))
+
+
+class GroupingModel:
+    """
+    Fitted grouping of an account's transactions. New transactions join the nearest group, or open new \
+    groups when no group is close enough, so updates cost grows with the new transactions only. \
+    Only per-group statistics are kept, not the transactions, so saving the model doesn't grow with the history
+    :param distance_threshold: largest euclidean distance between a narration's feature vector and a \
+    group centroid for the transaction to join that group :type float
+    """
+
+    def __init__(self, distance_threshold=1.0):
+        self.distance_threshold = distance_threshold
+        self.vectorizer = None
+        self.centroid_sums = None  # sparse matrix holding the sum of the feature vectors of each group
+        self.counts = np.zeros(0, dtype=np.int64)  # transactions in each group
+        self.gap_sums = np.zeros(0)  # sum of days between consecutive transactions of each group
+        self.gap_counts = np.zeros(0, dtype=np.int64)  # number of those differences
+        self.last_days = np.zeros(0, dtype=np.int64)  # day of the latest transaction added to each group
+
+    def __setstate__(self, state):
+        # models saved before the history was dropped still carry it, it isn't written back
+        state.pop("columns", None)
+        state.pop("labels", None)
+        self.__dict__.update(state)
+
+    def fit(self, response_list, normalizer=None, vectorizer="tfidf", clustering="kmeans", cluster_ratio=3.2,
+            max_clusters=None):
+        """
+        Clusters an account's history, replacing any previous state
+        :param response_list: list of dictionary containing transaction data :type list
+        :param normalizer: narration normalizer, the shared default one is used if None :type NarrationNormalizer
+        :param vectorizer: "tfidf" or "hashing", hashing also gives features to words unseen while fitting \
+        :type str
+        :param clustering: "kmeans" or "minibatch", see cluster_features :type str
+        :param cluster_ratio: average number of transactions per group :type float
+        :param max_clusters: upper bound on the number of groups, None for no bound :type int
+        :return: group name of each transaction :type list of str
+        """
+        normalizer = normalizer or default_normalizer()
+        narrations = [normalizer(response["narration"]) for response in response_list]
+        if not any(text.split() for text in narrations):
+            # the vectorizer needs at least one word, new transactions could never be placed otherwise
+            raise ValueError("the history needs at least one narration with words to fit a model")
+        dates = [response["date"] for response in response_list]
+        vectorizer = make_vectorizer(vectorizer)
+        features = vectorizer.fit_transform(narrations)
+        n_clusters = min(choose_n_clusters(len(narrations), cluster_ratio, max_clusters), len(set(narrations)))
+        labels = cluster_features(features, n_clusters, clustering)
+        self.vectorizer = vectorizer
+        self.centroid_sums = (group_indicator(labels, n_clusters) @ features).tocsr()
+        self.counts = np.bincount(labels, minlength=n_clusters)
+
+        # every transaction after the first in a group adds one difference in days
+        self.gap_counts = np.maximum(self.counts - 1, 0)
+        self.gap_sums = date_gap_statistics(dates, labels, n_clusters)["mean"] * self.gap_counts
+        order = np.argsort(labels, kind="stable")
+        last = order[np.maximum(np.cumsum(self.counts) - 1, 0)]
+        self.last_days = np.where(self.counts > 0, parse_days(dates)[last], 0)
+        return [f"group{label+1}" for label in labels.tolist()]
+
+    def assign(self, features, narrations):
+        """
+        Finds the group of each new transaction, opening new groups for those far from every group
+        :param features: feature vectors of the new narrations, one row each
+        :param narrations: normalized new narrations :type list of str
+        :return: (group label of each row, number of groups including the new ones) :type tuple
+        """
+        centroids = self.centroid_sums.multiply(1 / np.maximum(self.counts, 1)[:, None]).tocsr()
+        row_norms = np.asarray(features.multiply(features).sum(axis=1)).ravel()
+        centroid_norms = np.asarray(centroids.multiply(centroids).sum(axis=1)).ravel()
+        distances = row_norms[:, None] + centroid_norms[None, :] - 2 * (features @ centroids.T).toarray()
+        distances[:, self.counts == 0] = np.inf
+        labels = np.full(features.shape[0], -1, dtype=np.intp)
+        if distances.shape[1]:
+            nearest = distances.argmin(axis=1)
+            close = np.sqrt(np.maximum(distances[np.arange(len(nearest)), nearest], 0)) <= self.distance_threshold
+            # narrations without any known feature are equally close to everything, so they never join a group
+            labels = np.where(close & (row_norms > 0), nearest, -1)
+
+        # the rest is grouped among itself, each new group is led by its first transaction
+        n_groups = len(self.counts)
+        leaders = []  # (row, label) of the transaction that opened each new group
+        for i in np.flatnonzero(labels < 0).tolist():
+            for leader, label in leaders:
+                if row_norms[i] == 0 or row_norms[leader] == 0:
+                    same = narrations[i] == narrations[leader]
+                else:
+                    distance = row_norms[i] + row_norms[leader] - 2 * features[i].multiply(features[leader]).sum()
+                    same = np.sqrt(max(distance, 0)) <= self.distance_threshold
+                if same:
+                    labels[i] = label
+                    break
+            else:
+                labels[i] = n_groups
+                leaders.append((i, n_groups))
+                n_groups += 1
+        return labels, n_groups
+
+    def add(self, response_list, normalizer=None):
+        """
+        Adds new transactions to the nearest groups and updates the groups' centroids and days between transactions
+        :param response_list: list of dictionary containing the new transaction data :type list
+        :param normalizer: narration normalizer, the shared default one is used if None :type NarrationNormalizer
+        :return: group name of each new transaction :type list of str
+        """
+        if self.vectorizer is None:
+            raise ValueError("the model has to be fitted before transactions are added")
+        if not response_list:
+            return []
+        from scipy.sparse import csr_matrix, vstack
+        normalizer = normalizer or default_normalizer()
+        narrations = [normalizer(response["narration"]) for response in response_list]
+        features = self.vectorizer.transform(narrations)
+        labels, n_groups = self.assign(features, narrations)
+
+        n_new_groups = n_groups - len(self.counts)
+        self.centroid_sums = vstack([self.centroid_sums, csr_matrix((n_new_groups, features.shape[1]))]).tocsr()
+        self.centroid_sums = (self.centroid_sums + group_indicator(labels, n_groups) @ features).tocsr()
+        self.counts = np.concatenate([self.counts, np.zeros(n_new_groups, dtype=np.int64)])
+        self.gap_sums = np.concatenate([self.gap_sums, np.zeros(n_new_groups)])
+        self.gap_counts = np.concatenate([self.gap_counts, np.zeros(n_new_groups, dtype=np.int64)])
+        self.last_days = np.concatenate([self.last_days, np.zeros(n_new_groups, dtype=np.int64)])
+
+        days = parse_days([response["date"] for response in response_list])
+        for label, day in zip(labels.tolist(), days.tolist()):
+            if self.counts[label]:
+                self.gap_sums[label] += abs(day - self.last_days[label])
+                self.gap_counts[label] += 1
+            self.counts[label] += 1
+            self.last_days[label] = day
+        return [f"group{label+1}" for label in labels.tolist()]
+
+    def groups(self, response_list, group_names):
+        """
+        Groups transactions the model has named, e.g. the history passed to fit
+        :param response_list: list of dictionary containing transaction data :type list
+        :param group_names: group name of each transaction, as returned by fit or add :type list of str
+        :return: grouped transactions along side average number of days between transactions for each group, \
+        in the same format as transaction_grouping, groups without any of the transactions are left out
+        """
+        averages = np.where(self.gap_counts > 0, self.gap_sums / np.maximum(self.gap_counts, 1), 0)
+        groups = {f"group{i+1}": {"average_number_of_days_between_transactions": round(average),
+                                  "transactions": []}
+                  for i, average in enumerate(averages.tolist())}
+        for response, name in zip(response_list, group_names):
+            groups[name]["transactions"].append(response)
+        return {name: group for name, group in groups.items() if group["transactions"]}
+
+    def save(self, path):
+        """
+        Writes the model to path, replacing the file in one step so readers never see a partial model. \
+        Every call writes its own temporary file, so concurrent saves can't interleave their bytes
+        :param path: file path :type str
+        """
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: file written by save :type str
+        :return: the saved model :type GroupingModel
+        """
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+
+class ResultCache:
+    """
+    LRU cache of grouped statements with optional expiry and an optional SQLite file behind it, \
+    so results survive worker restarts and are shared by workers on the same machine. \
+    Cached results are returned as stored, callers must not modify them. \
+    Failing SQLite calls, e.g. a database locked by other workers, are counted as errors instead of raised
+    :param max_size: number of results kept, in memory and on disk :type int
+    :param ttl: seconds a result stays valid, None for no expiry :type float
+    :param path: SQLite file backing the cache, None to keep results in memory only :type str
+    :param max_rows: transactions held in memory by all results together, bounding the cache's memory \
+    since results grow with their statements, None for no bound :type int
+    """
+
+    def __init__(self, max_size=256, ttl=None, path=None, max_rows=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.entries = OrderedDict()  # key mapped to (time stored, result, rows), least recently used first
+        self.rows = 0  # transactions in the results held in memory
+        self.counts = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "errors": 0}
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                            "(key TEXT PRIMARY KEY, stored REAL, used REAL, result TEXT)")
+
+    def expired(self, stored):
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    @contextmanager
+    def database(self):
+        """
+        Transaction on the SQLite file, errors end it and are counted, the cache then works from memory
+        """
+        try:
+            with self.db:
+                yield self.db
+        except sqlite3.Error:
+            self.counts["errors"] += 1
+
+    def get(self, key):
+        """
+        :param key: statement key, see statement_key :type str
+        :return: cached result or None :type dict
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.db is not None:
+                with self.database() as db:
+                    row = db.execute("SELECT stored, result FROM results WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        entry = self.store(key, row[0], json.loads(row[1]))
+                        # disk recency is only refreshed on reads that miss memory, keeping memory hits write free
+                        db.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+            if entry is not None and self.expired(entry[0]):
+                self.counts["expirations"] += 1
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.counts["misses"] += 1
+                return None
+            self.counts["hits"] += 1
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, result):
+        """
+        :param key: statement key, see statement_key :type str
+        :param result: grouped transactions :type dict
+        """
+        with self.lock:
+            now = time.time()
+            self.store(key, now, result)
+            if self.db is not None:
+                with self.database() as db:
+                    db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                               (key, now, now, json.dumps(result)))
+                    evicted = db.execute("DELETE FROM results WHERE key NOT IN "
+                                         "(SELECT key FROM results ORDER BY used DESC LIMIT ?)",
+                                         (self.max_size,)).rowcount
+                    self.counts["evictions"] += evicted
+
+    def store(self, key, stored, result):
+        """
+        Keeps a result in memory, evicting the least recently used ones beyond max_size and max_rows
+        :return: the entry, also when the result alone has more than max_rows transactions and isn't kept \
+        :type tuple
+        """
+        rows = sum(len(group["transactions"]) for group in result.values())
+        entry = (stored, result, rows)
+        self.discard(key)
+        if self.max_rows is not None and rows > self.max_rows:
+            return entry
+        self.entries[key] = entry
+        self.rows += rows
+        while len(self.entries) > self.max_size or (self.max_rows is not None and self.rows > self.max_rows):
+            self.rows -= self.entries.popitem(last=False)[1][2]
+            # with a file behind the cache, results dropped from memory are still on disk
+            if self.db is None:
+                self.counts["evictions"] += 1
+        return entry
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.rows -= entry[2]
+
+    def remove(self, key):
+        self.discard(key)
+        if self.db is not None:
+            with self.database() as db:
+                db.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.rows = 0
+            if self.db is not None:
+                with self.database() as db:
+                    db.execute("DELETE FROM results")
+
+    def metrics(self):
+        """
+        :return: hits, misses, evictions, expirations, SQLite errors and current number of results in memory \
+        :type dict
+        """
+        with self.lock:
+            return dict(self.counts, size=len(self.entries))
+
+
+def statement_key(response_list, options=None):
+    """
+    Stable hash of a statement and the grouping options it is grouped with
+    :param response_list: list of dictionary containing transaction data :type list
+    :param options: grouping options, see label_transactions, the profile is ignored :type dict
+    :return: hex digest :type str
+    """
+    options = {name: value for name, value in (options or {}).items() if name != "profile"}
+    normalizer = options.pop("normalizer", None)
+    if normalizer is not None and normalizer is not default_normalizer():
+        # results depend on the normalizer, other callables only match themselves within a process
+        options["normalizer"] = normalizer.fingerprint() if isinstance(normalizer, NarrationNormalizer) \
+            else repr(normalizer)
+    # results depend on the store's vocabulary, its repr holds the build id
+    feature_store = options.get("feature_store") or default_feature_store()
+    if feature_store is not None:
+        options["feature_store"] = feature_store
+    rows = [[response["narration"], response["amount"], response["type"], response["date"]]
+            for response in response_list]
+    payload = json.dumps([sorted(options.items()), rows], separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def default_result_cache():
+    """
+    Cache configured by MONO_CACHE_SIZE (default 256, 0 disables caching), MONO_CACHE_ROWS, the transactions \
+    held in memory by all results together (default 50000), MONO_CACHE_TTL in seconds and MONO_CACHE_PATH, \
+    an SQLite file
+    :return: shared result cache, None if disabled :type ResultCache
+    """
+    max_size = int(os.environ.get("MONO_CACHE_SIZE", 256))
+    if max_size <= 0:
+        return None
+    ttl = os.environ.get("MONO_CACHE_TTL")
+    return ResultCache(max_size, float(ttl) if ttl else None, os.environ.get("MONO_CACHE_PATH"),
+                       int(os.environ.get("MONO_CACHE_ROWS", 50000)))
+
+
+def cached_transaction_grouping(response_list, cache=None, **options):
+    """
+    Groups transactions, reusing the result of an identical earlier statement
+    :param response_list: list of dictionary containing transaction data :type list
+    :param cache: result cache, statements are grouped without caching if None :type ResultCache
+    :param options: grouping options, see label_transactions
+    :return: grouped transactions along side average number of days between transactions for each group
+    """
+    if cache is None:
+        return transaction_grouping(response_list, **options)
+    profile = options.get("profile") or GroupingProfile()
+    with profile.stage("cache_lookup"):
+        key = statement_key(response_list, options)
+        result = cache.get(key)
+    profile.count("cached", int(result is not None))
+    if result is None:
+        result = transaction_grouping(response_list, **options)
+        cache.put(key, result)
+    return result
+
+
+def profiled_transaction_grouping(response_list, **options):
+    """
+    Groups transactions while profiling them, handy where the profile has to travel back from another process
+    :param response_list: list of dictionary containing transaction data :type list
+    :param options: grouping options, see label_transactions
+    :return: (grouped transactions, profile of the run) :type tuple
+    """
+    profile = GroupingProfile()
+    return transaction_grouping(response_list, profile=profile, **options), profile
+
+
+def batch_transaction_grouping(accounts, executor=None, max_workers=None, **options):
+    """
+    Groups the transactions of many accounts in parallel processes, so the CPU bound clustering \
+    isn't held back by the GIL
+    :param accounts: account id mapped to its list of transaction dictionaries :type dict
+    :param executor: process pool to run on, a temporary one is created if None :type ProcessPoolExecutor
+    :param max_workers: size of the temporary pool, defaults to the number of cores :type int
+    :param options: grouping options, see label_transactions
+    :return: account id mapped to its grouped transactions :type dict
+    """
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=warm_up) as executor:
+            return batch_transaction_grouping(accounts, executor, max_workers, **options)
+    # a few chunks per worker balance uneven account sizes without paying inter-process overhead per account
+    n_workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(accounts) // (n_workers * 4))
+    results = executor.map(partial(transaction_grouping, **options), accounts.values(), chunksize=chunksize)
+    return dict(zip(accounts, results))
+
+
+@lru_cache(maxsize=None)
+def shared_process_pool(max_workers=None):
+    """
+    :param max_workers: number of processes, defaults to the number of cores :type int
+    :return: process pool reused across batches, its workers are warmed up when they start :type ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=warm_up)
+
+
+def warm_up(normalizer=None):
+    """
+    Loads corpora, heavy modules and the feature store and primes the normalizer caches so the first request \
+    isn't slowed down. Calling it in a server's master process before workers fork lets the workers share \
+    the loaded pages
+    :param normalizer: normalizer to prime, the shared default one is used if None :type NarrationNormalizer
+    """
+    default_feature_store()
+    transaction_grouping(WARM_UP_STATEMENT, normalizer=normalizer)
+    canonical_buckets([transaction["narration"] for transaction in WARM_UP_STATEMENT])
+
+
+# e.g. gunicorn --preload imports the app once in the master process, so workers fork warmed up
+if env_flag("MONO_PRELOAD"):
+    warm_up()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,155 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache, partial
 import uvicorn
-from fastapi import FastAPI
-from mono import transaction_grouping
-from pydantic import BaseModel
-from typing import List
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from mono import (GroupingModel, GroupingProfile, TransactionColumns, batch_transaction_grouping,
+                  cached_transaction_grouping, default_result_cache, encode_groups, env_flag, json_loads, label_columns,
+                  profiled_transaction_grouping, shared_process_pool, statement_key, warm_up)
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, parse_obj_as
+from typing import Dict, List
+try:
+    import fcntl
+except ImportError:  # no file locks on Windows, account updates are then only serialized within a process
+    fcntl = None
 
 app = FastAPI()
+# fitted per-account grouping models are kept in this directory
+MODEL_DIR = os.environ.get("MONO_MODEL_DIR", "models")
+account_locks = {}  # account id mapped to its lock, used where fcntl is unavailable
+account_locks_lock = threading.Lock()
+
+
+class Metrics:
+    """
+    Process wide request and grouping stage metrics, rendered in the Prometheus text format by /metrics
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (route, status) mapped to [count, total seconds]
+        self.stage_seconds = {}
+        self.counters = {}
+
+    def record_request(self, route, status, seconds):
+        with self.lock:
+            entry = self.requests.setdefault((route, status), [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_profile(self, profile):
+        with self.lock:
+            for stage, seconds in profile.stages.items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0) + seconds
+            for name, value in profile.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def render(self):
+        with self.lock:
+            lines = ["# TYPE mono_requests_total counter"]
+            lines += [f'mono_requests_total{{route="{route}",status="{status}"}} {count}'
+                      for (route, status), (count, _) in sorted(self.requests.items())]
+            lines.append("# TYPE mono_request_seconds_total counter")
+            lines += [f'mono_request_seconds_total{{route="{route}",status="{status}"}} {seconds}'
+                      for (route, status), (_, seconds) in sorted(self.requests.items())]
+            lines.append("# TYPE mono_stage_seconds_total counter")
+            lines += [f'mono_stage_seconds_total{{stage="{stage}"}} {seconds}'
+                      for stage, seconds in sorted(self.stage_seconds.items())]
+            for name, value in sorted(self.counters.items()):
+                lines += [f"# TYPE mono_{name}_total counter", f"mono_{name}_total {value}"]
+        cache = default_result_cache()
+        if cache is not None:
+            for name, value in cache.metrics().items():
+                kind = "gauge" if name == "size" else "counter"
+                metric = f"mono_cache_{name}" if kind == "gauge" else f"mono_cache_{name}_total"
+                lines += [f"# TYPE {metric} {kind}", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Lane:
+    """
+    Bounded executor for grouping. Up to max_workers statements are grouped at once and up to queue_depth \
+    more wait, anything beyond that is turned away with a 503 and Retry-After instead of piling up
+    :param make_executor: creates the thread or process pool running the grouping, called again to replace \
+    a process pool that broke :type callable
+    :param max_workers: size of the pool :type int
+    :param queue_depth: number of statements allowed to wait for a worker :type int
+    """
+
+    def __init__(self, make_executor, max_workers, queue_depth):
+        self.make_executor = make_executor
+        self.executor = make_executor()
+        self.limit = max_workers + queue_depth
+        # only touched from the event loop, so it needs no lock
+        self.pending = 0
+
+    async def run(self, func, *args):
+        if self.pending >= self.limit:
+            metrics.count("rejected_requests")
+            raise HTTPException(status_code=503, detail="grouping capacity exhausted, retry later",
+                                headers={"Retry-After": os.environ.get("MONO_RETRY_AFTER", "1")})
+        self.pending += 1
+        try:
+            executor = self.executor
+            try:
+                return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+            except BrokenProcessPool:
+                # a worker died and the pool never recovers, so it's replaced, unless a request that failed \
+                # alongside already did so, and the statement is retried once
+                if self.executor is executor:
+                    executor.shutdown(wait=False)
+                    self.executor = self.make_executor()
+                return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+
+@lru_cache(maxsize=None)
+def grouping_lanes():
+    """
+    Lanes configured by MONO_EXECUTOR ("thread" or "process"), MONO_MAX_CONCURRENCY (default: number of cores), \
+    MONO_QUEUE_DEPTH (default: twice the concurrency), MONO_FAST_LANE_ROWS (default 200) and \
+    MONO_FAST_LANE_WORKERS (default 2). Statements up to MONO_FAST_LANE_ROWS transactions use the fast lane \
+    so they don't wait behind long KMeans fits
+    :return: (fast lane, main lane, fast lane row limit) :type tuple
+    """
+    max_workers = int(os.environ.get("MONO_MAX_CONCURRENCY", os.cpu_count() or 1))
+    queue_depth = int(os.environ.get("MONO_QUEUE_DEPTH", 2 * max_workers))
+    fast_workers = int(os.environ.get("MONO_FAST_LANE_WORKERS", 2))
+    if os.environ.get("MONO_EXECUTOR", "thread") == "process":
+        make_executor = partial(ProcessPoolExecutor, max_workers=max_workers, initializer=warm_up)
+    else:
+        make_executor = partial(ThreadPoolExecutor, max_workers=max_workers, thread_name_prefix="grouping")
+    fast_lane = Lane(partial(ThreadPoolExecutor, max_workers=fast_workers, thread_name_prefix="grouping-fast"),
+                     fast_workers, queue_depth)
+    return fast_lane, Lane(make_executor, max_workers, queue_depth), int(os.environ.get("MONO_FAST_LANE_ROWS", 200))
+
+
+@lru_cache(maxsize=None)
+def grouping_options():
+    """
+    Grouping options every endpoint applies, MONO_FAST_PATH=1 groups narrations that only differ in digits, \
+    ids and months without clustering them
+    :return: options passed on to transaction_grouping, callers must not modify them :type dict
+    """
+    return {"fast_path": True} if env_flag("MONO_FAST_PATH") else {}
+
 
 class Transaction(BaseModel):
     narration: str
@@ -13,11 +158,320 @@ class Transaction(BaseModel):
     date: str
 
 
+def model_path(account_id):
+    """
+    :param account_id: account the model belongs to, letters, digits, "-" and "_" only :type str
+    :return: file holding the account's grouping model :type str
+    """
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", account_id):
+        raise HTTPException(status_code=422, detail="account id may only hold letters, digits, - and _")
+    return os.path.join(MODEL_DIR, f"{account_id}.pkl")
+
+
+@contextmanager
+def account_lock(account_id):
+    """
+    Holds an exclusive lock on an account's model, across threads and worker processes, \
+    so concurrent updates of the account don't overwrite each other. Other accounts aren't blocked
+    :param account_id: account the model belongs to :type str
+    """
+    if fcntl is None:
+        with account_locks_lock:
+            lock = account_locks.setdefault(account_id, threading.Lock())
+        with lock:
+            yield
+        return
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    with open(os.path.join(MODEL_DIR, f"{account_id}.lock"), "a") as file:
+        # released when the file is closed
+        fcntl.flock(file, fcntl.LOCK_EX)
+        yield
+
+
+def read_transactions(body):
+    """
+    Decodes and validates a statement the way FastAPI does for a List[Transaction] body, \
+    for endpoints that do it off the event loop
+    :param body: JSON list of transactions :type bytes
+    :return: list of dictionary containing transaction data :type list
+    """
+    try:
+        return [transaction.dict() for transaction in parse_obj_as(List[Transaction], json_loads(body))]
+    except ValueError as error:  # JSON decoding and pydantic validation errors alike
+        raise HTTPException(status_code=422, detail=f"invalid statement: {error}")
+
+
+def append_transaction(columns, transaction, line_number=None):
+    """
+    Appends one decoded transaction to the statement columns
+    :param columns: statement being read :type TransactionColumns
+    :param transaction: decoded JSON transaction :type dict
+    :param line_number: position of the transaction in the request body, used in errors :type int
+    """
+    try:
+        columns.append(str(transaction["narration"]), int(transaction["amount"]), str(transaction["type"]),
+                       str(transaction["date"]))
+    except (ValueError, TypeError, KeyError, OverflowError) as error:
+        where = f" on line {line_number}" if line_number is not None else ""
+        raise HTTPException(status_code=422, detail=f"invalid transaction{where}: {error!r}")
+
+
+def check_dates(columns):
+    """
+    Rejects a statement with dates that can't be parsed, before any grouping work or response starts
+    :param columns: statement read from the request :type TransactionColumns
+    """
+    try:
+        columns.days()
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=f"invalid transaction date: {error}")
+
+
+def append_line(columns, line, line_number):
+    """
+    Parses one NDJSON line into the statement columns, blank lines are skipped
+    :param columns: statement being read :type TransactionColumns
+    :param line: JSON encoded transaction :type bytes
+    :param line_number: position of the line in the request body, used in errors :type int
+    """
+    if not line.strip():
+        return
+    try:
+        transaction = json_loads(line)
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=f"invalid JSON on line {line_number}: {error!r}")
+    append_transaction(columns, transaction, line_number)
+
+
+@lru_cache(maxsize=None)
+def route_paths():
+    """
+    :return: endpoint function mapped to its route template, built once all routes are registered :type dict
+    """
+    return {route.endpoint: route.path for route in app.routes if hasattr(route, "endpoint")}
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # the route template keeps account ids out of the metric labels, starlette only sets the matched endpoint
+    route = route_paths().get(request.scope.get("endpoint"), "unmatched")
+    metrics.record_request(route, response.status_code, time.perf_counter() - start)
+    return response
+
+
+@app.on_event("startup")
+def warm_up_worker():
+    # with MONO_WARM_UP set each worker primes corpora, models and caches before serving requests
+    if env_flag("MONO_WARM_UP") and not env_flag("MONO_PRELOAD"):
+        warm_up()
+
+
+@app.on_event("shutdown")
+def shut_down_process_pool():
+    if shared_process_pool.cache_info().currsize:
+        shared_process_pool().shutdown()
+    if grouping_lanes.cache_info().currsize:
+        for lane in grouping_lanes()[:2]:
+            lane.executor.shutdown()
+
+
 @app.post("/")
-def grouptransactions(transactions: List[Transaction]):
+def grouptransactions(transactions: List[Transaction], profile: bool = False):
+    """
+    Groups transactions, with profile=true the response also holds the time spent in each grouping stage
+    """
     transactions = [transaction.dict() for transaction in transactions]
-    data = transaction_grouping(transactions)
+    grouping_profile = GroupingProfile()
+    data = cached_transaction_grouping(transactions, default_result_cache(), profile=grouping_profile,
+                                       **grouping_options())
+    metrics.record_profile(grouping_profile)
+    response = {
+        "status": "success",
+        "data": data
+    }
+    if profile:
+        response["profile"] = grouping_profile.as_dict()
+    return response
+
+
+@app.post("/async")
+async def grouptransactions_async(request: Request, profile: bool = False):
+    """
+    Groups transactions on a bounded executor without blocking the event loop, \
+    answering 503 with Retry-After when too many statements are already being grouped
+    """
+    body = await request.body()
+    cache = default_result_cache()
+    grouping_profile = GroupingProfile()
+
+    def read():
+        # validating the statement, hashing it and reading SQLite are CPU and disk work, so along with cache \
+        # hits, which don't take a grouping worker, they run in starlette's threadpool
+        transactions = read_transactions(body)
+        if cache is None:
+            return transactions, None, None
+        with grouping_profile.stage("cache_lookup"):
+            key = statement_key(transactions, grouping_options())
+            return transactions, key, cache.get(key)
+
+    transactions, key, data = await run_in_threadpool(read)
+    del body
+    cached = data is not None
+    if cached:
+        grouping_profile.count("cached")
+    else:
+        fast_lane, lane, fast_lane_rows = grouping_lanes()
+        if len(transactions) <= fast_lane_rows:
+            lane = fast_lane
+        data, worker_profile = await lane.run(partial(profiled_transaction_grouping, **grouping_options()),
+                                              transactions)
+        grouping_profile.stages.update(worker_profile.stages)
+        grouping_profile.counters.update(worker_profile.counters)
+    metrics.record_profile(grouping_profile)
+
+    def encode():
+        if cache is not None and not cached:
+            cache.put(key, data)
+        response = {
+            "status": "success",
+            "data": data
+        }
+        if profile:
+            response["profile"] = grouping_profile.as_dict()
+        # same bytes FastAPI's JSONResponse would give
+        return json.dumps(response, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+    return Response(content=await run_in_threadpool(encode), media_type="application/json")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return metrics.render()
+
+
+@app.post("/batch")
+def grouptransactions_batch(accounts: Dict[str, List[Transaction]]):
+    """
+    Groups the transactions of many accounts at once, spread over a process pool with one worker per core
+    """
+    accounts = {account: [transaction.dict() for transaction in transactions]
+                for account, transactions in accounts.items()}
+    pool = shared_process_pool()
+    try:
+        data = batch_transaction_grouping(accounts, pool, **grouping_options())
+    except BrokenProcessPool:
+        # a worker died, e.g. killed for memory or failing to warm up, and a broken pool never recovers, \
+        # so it's replaced unless another request already did so, and the batch is retried once
+        if shared_process_pool() is pool:
+            shared_process_pool.cache_clear()
+        pool.shutdown(wait=False)
+        data = batch_transaction_grouping(accounts, shared_process_pool(), **grouping_options())
     return {
         "status": "success",
         "data": data
-    }
\ No newline at end of file
+    }
+
+
+@app.post("/accounts/{account_id}")
+def fit_account(account_id: str, transactions: List[Transaction]):
+    """
+    Groups an account's full history and keeps the fitted model for later incremental updates
+    """
+    path = model_path(account_id)
+    response_list = [transaction.dict() for transaction in transactions]
+    model = GroupingModel()
+    try:
+        group_names = model.fit(response_list)
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    with account_lock(account_id):
+        model.save(path)
+    return {
+        "status": "success",
+        "data": model.groups(response_list, group_names)
+    }
+
+
+@app.post("/accounts/{account_id}/transactions")
+def add_account_transactions(account_id: str, transactions: List[Transaction]):
+    """
+    Adds new transactions to an account's fitted groups without re-clustering its history, \
+    returning the group name of each new transaction in the order given
+    """
+    path = model_path(account_id)
+    with account_lock(account_id):
+        if not os.path.exists(path):
+            raise HTTPException(status_code=404, detail=f"no fitted model for account {account_id}")
+        model = GroupingModel.load(path)
+        try:
+            group_names = model.add([transaction.dict() for transaction in transactions])
+        except ValueError as error:
+            raise HTTPException(status_code=422, detail=str(error))
+        model.save(path)
+    return {
+        "status": "success",
+        "data": group_names
+    }
+
+
+@app.post("/ndjson")
+async def grouptransactions_ndjson(request: Request):
+    """
+    Accepts one JSON transaction per line and streams back one JSON group per line, \
+    so neither the statement nor the result is held as a whole in request or response objects
+    """
+    columns = TransactionColumns()
+    pending = b""
+    line_number = 0
+    async for chunk in request.stream():
+        lines = (pending + chunk).split(b"\n")
+        # the last piece may be an incomplete line, so it waits for the next chunk
+        pending = lines.pop()
+        for line in lines:
+            line_number += 1
+            append_line(columns, line, line_number)
+    append_line(columns, pending, line_number + 1)
+    check_dates(columns)
+    grouping_profile = GroupingProfile()
+    # grouped before streaming starts, so failures get an error status instead of a cut off 200
+    grouping = await run_in_threadpool(label_columns, columns, grouping_profile, **grouping_options())
+
+    def group_lines():
+        # iterated in starlette's threadpool, so encoding doesn't block the event loop
+        for name, group in encode_groups(columns, grouping_profile, grouping):
+            yield b'{"group":"%b",%b\n' % (name.encode(), group[1:])
+        metrics.record_profile(grouping_profile)
+
+    return StreamingResponse(group_lines(), media_type="application/x-ndjson")
+
+
+@app.post("/columnar")
+async def grouptransactions_columnar(request: Request):
+    """
+    Same input and output as /, but the statement is read into compact columns and the response is encoded \
+    straight from them, skipping per-transaction models and dictionaries
+    """
+    try:
+        transactions = json_loads(await request.body())
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=f"invalid JSON: {error!r}")
+    if not isinstance(transactions, list):
+        raise HTTPException(status_code=422, detail="expected a list of transactions")
+    columns = TransactionColumns()
+    for transaction in transactions:
+        append_transaction(columns, transaction)
+    del transactions
+    check_dates(columns)
+
+    def encode():
+        grouping_profile = GroupingProfile()
+        groups = b",".join([b'"%b":%b' % (name.encode(), group)
+                            for name, group in encode_groups(columns, profile=grouping_profile,
+                                                             **grouping_options())])
+        metrics.record_profile(grouping_profile)
+        return b'{"status":"success","data":{%b}}' % groups
+
+    return Response(content=await run_in_threadpool(encode), media_type="application/json")